@@ -0,0 +1,252 @@
+from collections import Counter, deque
+from collections.abc import Mapping
+from copy import copy
+from datetime import datetime
+from threading import Lock
+from time import monotonic
+from typing import Any, Final, Optional
+
+from apscheduler.executors.asyncio import AsyncIOExecutor
+from apscheduler.executors.base import BaseExecutor
+from apscheduler.executors.pool import ThreadPoolExecutor
+from apscheduler.job import Job
+
+from deck_chores import metrics
+from deck_chores.config import cfg
+from deck_chores.indexes import container_name
+from deck_chores.parsers import PRIORITIES
+from deck_chores.utils import log
+
+
+####
+
+
+# the executions of jobs are limited per service, or per container if it isn't
+# identified as part of a service, and overall
+Key = tuple[str, ...]
+# the executor, the job, its run times and when it was queued
+Submission = tuple["AdmittingExecutor", Job, list[datetime], float]
+# the index of the priority in PRIORITIES and the admission key
+QueueKey = tuple[int, Key]
+
+_lock: Final = Lock()
+_running: Final[Counter[Key]] = Counter()
+# the keys of the admitted instances per job id
+_admitted: Final[dict[str, list[Key]]] = {}
+# the instances per job id whose admission is released after their execution was
+# handed over to the watcher
+_handed_over: Final[Counter[str]] = Counter()
+# there's a queue per key and priority, those with the highest priority are
+# considered in the order of the dictionary, a queue is moved to its end when a
+# submission was taken from it
+_queues: Final[dict[QueueKey, deque[Submission]]] = {}
+# the most recent times that submissions were queued per priority
+_waits: Final[dict[str, deque[float]]] = {
+    priority: deque(maxlen=metrics.TIMINGS_SIZE) for priority in PRIORITIES
+}
+
+
+def admission_key(definition: Mapping[str, Any]) -> Key:
+    return definition.get('service_id') or (definition['container_id'],)
+
+
+def admissible(key: Key, definition: Mapping[str, Any]) -> bool:
+    if cfg.job_concurrency and _running.total() >= cfg.job_concurrency:
+        return False
+    limit = definition.get('concurrency') or cfg.service_concurrency
+    return not limit or _running[key] < limit
+
+
+def priority_index(definition: Mapping[str, Any]) -> int:
+    return PRIORITIES.index(definition.get('priority', 'normal'))
+
+
+def admit(job_id: str, key: Key):
+    _running[key] += 1
+    _admitted.setdefault(job_id, []).append(key)
+
+
+def submit(executor: "AdmittingExecutor", job: Job, run_times: list[datetime]):
+    """Dispatches a job's execution if the limits allow it, otherwise it's queued
+    behind previous submissions for the same service with the same or a higher
+    priority."""
+    definition = job.kwargs
+    key = admission_key(definition)
+    index = priority_index(definition)
+    with _lock:
+        if admissible(key, definition) and not any(
+            k == key and i <= index for i, k in _queues
+        ):
+            admit(job.id, key)
+            queued = False
+        else:
+            _queues.setdefault((index, key), deque()).append(
+                (executor, job, run_times, monotonic())
+            )
+            queued = True
+
+    if not queued:
+        executor.dispatch(job, run_times)
+        return
+
+    metrics.increment("deck_chores_jobs_queued")
+    log.info(
+        f"{container_name(definition['container_id'])}: "
+        f"Queued {definition['job_name']}, the concurrency limit is reached."
+    )
+
+
+def hand_over(job_id: str):
+    """Marks an instance's admission to be released by the watcher of its execution
+    instead of the executor."""
+    with _lock:
+        if job_id in _admitted:
+            _handed_over[job_id] += 1
+
+
+def release(job_id: str, handed_over: bool = False):
+    """Releases an instance's admission and dispatches the queued submissions that
+    become admissible."""
+    with _lock:
+        if not handed_over and _handed_over[job_id]:
+            _handed_over[job_id] -= 1
+            if not _handed_over[job_id]:
+                del _handed_over[job_id]
+            return
+        keys = _admitted.get(job_id)
+        if not keys:
+            return
+        key = keys.pop()
+        if not keys:
+            del _admitted[job_id]
+        _running[key] -= 1
+        if _running[key] <= 0:
+            del _running[key]
+        submissions = take_admissible_submissions()
+
+    for executor, job, run_times, waited in submissions:
+        metrics.increment("deck_chores_jobs_queued", -1)
+        metrics.observe(
+            "deck_chores_queue_wait_seconds",
+            waited,
+            priority=job.kwargs.get('priority', 'normal'),
+        )
+        metrics.record_timing("queue_wait", job.kwargs['job_id'], waited)
+        executor.dispatch(extend_grace_time(job, waited), run_times)
+
+
+def take_admissible_submissions() -> list[Submission]:
+    """Takes the queues' heads that are admissible one at a time, those with the
+    highest priority first and from each queue of a priority in turn, hence
+    services with many queued submissions don't delay others'. The returned
+    submissions carry the time that they waited instead of when they were queued."""
+    result: list[Submission] = []
+    while True:
+        selected: Optional[QueueKey] = None
+        for queue_key, queue in _queues.items():
+            if (selected is None or queue_key[0] < selected[0]) and admissible(
+                queue_key[1], queue[0][1].kwargs
+            ):
+                selected = queue_key
+                if not selected[0]:
+                    break
+        if selected is None:
+            return result
+
+        queue = _queues.pop(selected)
+        executor, job, run_times, queued_at = queue.popleft()
+        if queue:
+            _queues[selected] = queue
+        admit(job.id, selected[1])
+        waited = monotonic() - queued_at
+        _waits[PRIORITIES[selected[0]]].append(waited)
+        result.append((executor, job, run_times, waited))
+
+
+def discard_queued(job_id: Optional[str] = None):
+    """Drops the queued submissions of a removed job or of all jobs."""
+    with _lock:
+        discarded: list[Submission] = []
+        for key, queue in tuple(_queues.items()):
+            kept: deque[Submission] = deque()
+            for submission in queue:
+                if job_id is None or submission[1].id == job_id:
+                    discarded.append(submission)
+                else:
+                    kept.append(submission)
+            if kept:
+                _queues[key] = kept
+            else:
+                del _queues[key]
+
+    for executor, job, _, _ in discarded:
+        metrics.increment("deck_chores_jobs_queued", -1)
+        executor.drop(job.id)
+
+
+def queue_wait_report() -> dict[str, dict[str, float]]:
+    """Returns the percentiles of the recent times that submissions were queued per
+    priority."""
+    with _lock:
+        return {
+            priority: metrics.summarize(waits) for priority, waits in _waits.items()
+        }
+
+
+def extend_grace_time(job: Job, seconds: float) -> Job:
+    """Returns a copy of the job whose misfire grace time includes the time it was
+    queued, as that isn't a delay of the scheduler."""
+    if job.misfire_grace_time is None:
+        return job
+    result = copy(job)
+    result._scheduler = job._scheduler
+    result._jobstore_alias = job._jobstore_alias
+    result.misfire_grace_time = job.misfire_grace_time + seconds
+    return result
+
+
+####
+
+
+class AdmittingExecutor(BaseExecutor):
+    """Passes the submissions of jobs' executions through the admission control.
+    This is mixed into APScheduler's executors."""
+
+    def _do_submit_job(self, job, run_times):
+        submit(self, job, run_times)
+
+    def _run_job_success(self, job_id, events):
+        metrics.increment("deck_chores_jobs_running", -1)
+        super()._run_job_success(job_id, events)
+        release(job_id)
+
+    def _run_job_error(self, job_id, exc, traceback=None):
+        metrics.increment("deck_chores_jobs_running", -1)
+        super()._run_job_error(job_id, exc, traceback)
+        release(job_id)
+
+    def dispatch(self, job: Job, run_times: list[datetime]):
+        metrics.increment("deck_chores_jobs_running")
+        super()._do_submit_job(job, run_times)
+
+    def drop(self, job_id: str):
+        """Accounts a queued instance as finished without running it."""
+        super()._run_job_success(job_id, [])
+
+
+class AdmittingAsyncIOExecutor(AdmittingExecutor, AsyncIOExecutor):
+    pass
+
+
+class AdmittingThreadPoolExecutor(AdmittingExecutor, ThreadPoolExecutor):
+    pass
+
+
+__all__ = (
+    AdmittingAsyncIOExecutor.__name__,
+    AdmittingThreadPoolExecutor.__name__,
+    discard_queued.__name__,
+    hand_over.__name__,
+    queue_wait_report.__name__,
+    release.__name__,
+)
@@ -0,0 +1,437 @@
+import asyncio
+import json
+import struct
+from collections.abc import AsyncIterator, Awaitable, Callable, Mapping
+from time import perf_counter, time_ns
+from typing import Any, Final, Optional
+from urllib.parse import urlencode
+
+from docker.errors import APIError
+from docker.models.containers import Container
+from docker.utils import format_environment, split_command
+
+from deck_chores import jobs
+from deck_chores.config import cfg
+from deck_chores.executions import (
+    captured_output,
+    handle_output,
+    log_exit_code,
+    record_run_time,
+)
+from deck_chores.indexes import container_name
+from deck_chores.main import (
+    coalesce_events,
+    dispatch_event,
+    event_statistics,
+    EVENTS_FILTERS,
+    EVENTS_QUEUE_SIZE,
+    EventsSubscription,
+    process_running_containers,
+    reconciliation_event,
+)
+from deck_chores.utils import log
+
+
+####
+
+
+READ_SIZE: Final = 2**16
+# the header of a frame in a multiplexed stream consists of the stream type, three
+# bytes padding and the payload's size
+STREAM_HEADER: Final = struct.Struct(">BxxxL")
+
+# references to the tasks that run in the background, the event loop only keeps weak
+# references to them
+background_tasks: Final[set[asyncio.Task]] = set()
+
+
+class AsyncDockerClient:
+    """A minimal client for the Docker Engine API on a unix socket. Each request uses
+    its own connection, hence requests can be issued concurrently."""
+
+    def __init__(self, socket_path: str, api_version: Optional[str] = None):
+        self.socket_path = socket_path
+        self.path_prefix = f"/v{api_version}" if api_version else ""
+
+    async def stream(
+        self,
+        method: str,
+        path: str,
+        params: Optional[Mapping[str, str]] = None,
+        body: Optional[Any] = None,
+    ) -> AsyncIterator[bytes]:
+        """Returns an iterator over the chunks of a response's body as soon as the
+        response's head was received."""
+        reader, writer = await asyncio.open_unix_connection(self.socket_path)
+        try:
+            writer.write(encode_request(method, self.path_prefix + path, params, body))
+            await writer.drain()
+            status, reason, headers = await read_head(reader)
+            if status >= 400:
+                content = b"".join([c async for c in read_body(reader, headers)])
+                raise APIError(
+                    f"{status} {reason} for {method} {path}",
+                    explanation=error_message(content),
+                )
+        except BaseException:
+            writer.close()
+            raise
+
+        return close_after(read_body(reader, headers), writer)
+
+    async def read(self, method: str, path: str, **kwargs) -> bytes:
+        return b"".join([c async for c in await self.stream(method, path, **kwargs)])
+
+    async def request(self, method: str, path: str, **kwargs) -> Any:
+        content = await self.read(method, path, **kwargs)
+        return json.loads(content) if content else None
+
+    async def exec_run(
+        self,
+        container_id: str,
+        cmd: str | list[str],
+        user: str = "",
+        environment: Optional[Mapping[str, str]] = None,
+        workdir: Optional[str] = None,
+        output: Optional[Callable[[bytes], Awaitable[Any]]] = None,
+    ) -> int:
+        """Behaves like docker-py's ``Container.exec_run`` with its defaults, but the
+        output is passed in chunks to the ``output`` coroutine function as it arrives
+        and only the exit code is returned."""
+        config = {
+            "AttachStdout": True,
+            "AttachStderr": True,
+            "Cmd": split_command(cmd) if isinstance(cmd, str) else cmd,
+            "Env": format_environment(environment or {}),
+            "Tty": False,
+            "User": user,
+        }
+        if workdir is not None:
+            config["WorkingDir"] = workdir
+
+        exec_id = (
+            await self.request("POST", f"/containers/{container_id}/exec", body=config)
+        )["Id"]
+        stream = await self.stream(
+            "POST", f"/exec/{exec_id}/start", body={"Detach": False, "Tty": False}
+        )
+        async for payload in demultiplex(stream):
+            if output is not None:
+                await output(payload)
+        return (await self.request("GET", f"/exec/{exec_id}/json"))["ExitCode"]
+
+
+def encode_request(
+    method: str,
+    path: str,
+    params: Optional[Mapping[str, str]],
+    body: Optional[Any],
+) -> bytes:
+    target = f"{path}?{urlencode(params)}" if params else path
+    lines = [f"{method} {target} HTTP/1.1", "Host: docker", "Connection: close"]
+    content = b""
+    if body is not None:
+        content = json.dumps(body).encode()
+        lines.append("Content-Type: application/json")
+    if body is not None or method in ("POST", "PUT"):
+        lines.append(f"Content-Length: {len(content)}")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode() + content
+
+
+async def read_head(reader: asyncio.StreamReader) -> tuple[int, str, dict[str, str]]:
+    status_line = (await reader.readline()).decode("latin-1").rstrip("\r\n")
+    if not status_line:
+        raise asyncio.IncompleteReadError(b"", None)
+    _, status, *reason = status_line.split(" ", 2)
+
+    headers = {}
+    while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    return int(status), "".join(reason), headers
+
+
+async def read_body(
+    reader: asyncio.StreamReader, headers: Mapping[str, str]
+) -> AsyncIterator[bytes]:
+    if headers.get("transfer-encoding") == "chunked":
+        while True:
+            line = await reader.readline()
+            if not line:
+                raise asyncio.IncompleteReadError(b"", None)
+            if not (size := int(line.split(b";")[0], 16)):
+                break
+            yield await reader.readexactly(size)
+            await reader.readline()
+    elif "content-length" in headers:
+        if length := int(headers["content-length"]):
+            yield await reader.readexactly(length)
+    else:
+        # a hijacked connection's stream ends when the daemon closes it
+        while chunk := await reader.read(READ_SIZE):
+            yield chunk
+
+
+async def close_after(
+    chunks: AsyncIterator[bytes], writer: asyncio.StreamWriter
+) -> AsyncIterator[bytes]:
+    try:
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        writer.close()
+
+
+async def read_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    buffer = b""
+    async for chunk in chunks:
+        *lines, buffer = (buffer + chunk).split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield line
+    if buffer.strip():
+        yield buffer
+
+
+async def demultiplex(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """Yields the payloads of stdout's and stderr's frames in a multiplexed stream."""
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        while len(buffer) >= STREAM_HEADER.size:
+            _, size = STREAM_HEADER.unpack_from(buffer)
+            start, end = STREAM_HEADER.size, STREAM_HEADER.size + size
+            if len(buffer) < end:
+                break
+            yield buffer[start:end]
+            buffer = buffer[end:]
+
+
+def error_message(content: bytes) -> str:
+    try:
+        return json.loads(content)["message"]
+    except (KeyError, TypeError, ValueError):
+        return content.decode(errors="replace")
+
+
+####
+
+
+client: Optional[AsyncDockerClient] = None
+
+
+async def exec_job(**definition) -> int:
+    jobs.record_start(definition['job_id'])
+    container_id = definition['container_id']
+    assert client is not None
+
+    if (state := jobs.cached_container_state(container_id)) is None:
+        # the inspection also provides the name, a cache miss in container_name
+        # would block the event loop
+        inspection = await client.request("GET", f"/containers/{container_id}/json")
+        name = inspection["Name"].lstrip("/")
+        state = inspection["State"]["Status"]
+    else:
+        name = container_name(container_id)
+
+    log.info(f"{name}: Executing '{definition['job_name']}'.")
+    jobs.assert_executable_state(state)
+
+    output = captured_output(definition, name)
+    started_at = perf_counter()
+    exit_code = await client.exec_run(
+        container_id,
+        cmd=definition['command'],
+        user=definition['user'],
+        environment=definition['environment'],
+        workdir=definition.get('workdir'),
+        output=lambda chunk: handle_output_later(output.feed, chunk),
+    )
+    await handle_output_later(output.close)
+    record_run_time(definition['job_id'], perf_counter() - started_at)
+    await handle_output_later(log_exit_code, definition, exit_code, output)
+    return exit_code
+
+
+async def handle_output_later(function: Callable, *args: Any):
+    if not handle_output(function, *args, block=False):
+        # the output handler is behind, hence the reading of the output is paused
+        # without blocking the event loop
+        await asyncio.to_thread(handle_output, function, *args)
+
+
+####
+
+
+async def subscribe_to_events() -> asyncio.Queue:
+    """Subscribes to the daemon's events and buffers the relevant ones in the
+    returned queue from a separate task, hence events that occur while running
+    containers are inspected are not missed."""
+    assert client is not None
+    events: asyncio.Queue = asyncio.Queue(maxsize=EVENTS_QUEUE_SIZE)
+    # the subscription is established when this call returns
+    stream = await client.stream(
+        "GET", "/events", params={"filters": json.dumps(EVENTS_FILTERS)}
+    )
+    task = asyncio.create_task(read_events(stream, events), name="event-reader")
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return events
+
+
+async def read_events(stream: AsyncIterator[bytes], events: asyncio.Queue):
+    """The equivalent of :func:`deck_chores.main.read_events`."""
+    subscription = EventsSubscription()
+
+    while True:
+        try:
+            async for event_json in read_lines(stream):
+                if (event := subscription.accept(event_json)) is not None:
+                    await events.put(event)
+        except Exception as e:
+            subscription.interrupted(e)
+        else:
+            subscription.interrupted(None)
+
+        resubscribed = await resubscribe(subscription, events)
+        if resubscribed is None:
+            await events.put(subscription.error)
+            return
+        stream = resubscribed
+
+
+async def resubscribe(
+    subscription: EventsSubscription, events: asyncio.Queue
+) -> Optional[AsyncIterator[bytes]]:
+    """The equivalent of :func:`deck_chores.main.resubscribe`."""
+    assert client is not None
+    params = {"filters": json.dumps(EVENTS_FILTERS)}
+    if (since := subscription.since) is not None:
+        params["since"] = since
+
+    for delay in subscription.delays:
+        await asyncio.sleep(delay)
+        try:
+            stream = await client.stream("GET", "/events", params=params)
+        except Exception as e:
+            subscription.reconnection_failed(e)
+            continue
+
+        if subscription.reconnected():
+            try:
+                await events.put(await take_snapshot())
+            except Exception as e:
+                log.error(f"Failed to list the running containers: {e}")
+        return stream
+
+    return None
+
+
+async def inspect_running_containers():
+    log.info("Inspecting running containers.")
+    assert client is not None
+    # the listing's items are the same as those of a sparse listing with docker-py
+    containers = [
+        Container(attrs=attributes)
+        for attributes in await client.request("GET", "/containers/json")
+    ]
+    # the labels are parsed with the synchronous client, while the event loop
+    # already buffers events
+    await asyncio.to_thread(process_running_containers, containers)
+
+
+async def listen(events: asyncio.Queue):
+    log.info("Listening to events.")
+    while True:
+        batch = await take_events(events)
+        event_statistics["max_batch_size"] = max(
+            event_statistics["max_batch_size"], len(batch)
+        )
+
+        for event in coalesce_events(batch):
+            if event is None:
+                return
+            if isinstance(event, Exception):
+                raise event
+            # the handlers use the synchronous client and alter the indexes, they're
+            # run one after another in a worker thread while jobs are executed
+            await asyncio.to_thread(dispatch_event, event)
+
+
+async def reconcile_periodically(events: asyncio.Queue):
+    """The equivalent of :func:`deck_chores.main.reconcile_periodically`."""
+    while True:
+        await asyncio.sleep(cfg.reconciliation_interval)
+        try:
+            await events.put(await take_snapshot())
+        except Exception as e:
+            log.error(f"Failed to list the running containers: {e}")
+
+
+async def take_snapshot() -> dict:
+    """The equivalent of :func:`deck_chores.main.take_snapshot`."""
+    assert client is not None
+    started_at, listing_started_at = time_ns(), perf_counter()
+    containers = [
+        Container(attrs=attributes)
+        for attributes in await client.request("GET", "/containers/json")
+    ]
+    return reconciliation_event(
+        containers, started_at, perf_counter() - listing_started_at
+    )
+
+
+async def take_events(events: asyncio.Queue) -> list:
+    """The equivalent of :func:`deck_chores.main.take_events`."""
+    loop = asyncio.get_running_loop()
+    batch = [await events.get()]
+    deadline = None
+
+    while batch[-1] is not None and not isinstance(batch[-1], Exception):
+        if deadline is None and cfg.events_debounce and batch[-1]["Action"] == "die":
+            deadline = loop.time() + cfg.events_debounce
+        try:
+            if deadline is None:
+                batch.append(events.get_nowait())
+            else:
+                batch.append(
+                    await asyncio.wait_for(
+                        events.get(), timeout=max(0, deadline - loop.time())
+                    )
+                )
+        except (asyncio.QueueEmpty, asyncio.TimeoutError):
+            break
+
+    return batch
+
+
+####
+
+
+async def run():
+    global client
+    client = AsyncDockerClient(
+        cfg.docker_host.removeprefix("unix:/"), cfg.client.api.api_version
+    )
+    jobs.use_event_loop(asyncio.get_running_loop(), exec_job)
+
+    events = await subscribe_to_events()
+    jobs.start_scheduler(paused=True)
+    await inspect_running_containers()
+    jobs.scheduler.resume()
+    if cfg.reconciliation_interval:
+        task = asyncio.create_task(reconcile_periodically(events), name="reconciler")
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+    try:
+        await listen(events)
+    finally:
+        jobs.scheduler.shutdown(wait=False)
+
+
+__all__ = (
+    AsyncDockerClient.__name__,
+    exec_job.__name__,
+    run.__name__,
+)
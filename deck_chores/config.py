@@ -61,6 +61,11 @@ def _test_daemon_socket(url: str) -> str:  # pragma: nocover
 def generate_config():
     cfg.__dict__.clear()
     cfg.client_timeout = int(getenv('CLIENT_TIMEOUT', DEFAULT_TIMEOUT_SECONDS))
+    cfg.container_state_checks = getenv('CONTAINER_STATE_CHECKS', 'cached')
+    if cfg.container_state_checks not in ('api', 'cached'):
+        raise ConfigurationError(
+            f'Invalid CONTAINER_STATE_CHECKS: {cfg.container_state_checks}'
+        )
     cfg.default_flags = split_string(
         getenv('DEFAULT_FLAGS', 'image,service'), sort=True
     )
@@ -69,22 +74,52 @@ def generate_config():
     )
     cfg.debug = trueish(getenv('DEBUG', 'no'))
     cfg.default_max = int(getenv('DEFAULT_MAX', 1))
+    cfg.events_debounce = float(getenv('EVENTS_DEBOUNCE', 0))
+    cfg.events_reconnect_attempts = int(getenv('EVENTS_RECONNECT_ATTEMPTS', 8))
+    cfg.inspection_workers = int(getenv('INSPECTION_WORKERS', 1))
+    cfg.job_concurrency = int(getenv('JOB_CONCURRENCY', 0))
+    cfg.job_execution = getenv('JOB_EXECUTION', 'blocking')
+    if cfg.job_execution not in ('blocking', 'watched'):
+        raise ConfigurationError(f'Invalid JOB_EXECUTION: {cfg.job_execution}')
     cfg.job_executor_pool_size = int(getenv('JOB_POOL_SIZE', 10))
     cfg.job_name_regex = getenv("JOB_NAME_REGEX", "[a-z0-9-]+")
+    cfg.job_store = getenv('JOB_STORE', '')
+    cfg.job_validator = getenv('JOB_VALIDATOR', 'compiled')
+    if cfg.job_validator not in ('cerberus', 'compiled'):
+        raise ConfigurationError(f'Invalid JOB_VALIDATOR: {cfg.job_validator}')
     cfg.label_ns = getenv('LABEL_NAMESPACE', 'deck-chores') + '.'
     cfg.logformat = getenv('LOG_FORMAT', '{asctime}|{levelname:8}|{message}')
+    cfg.metrics_port = int(getenv('METRICS_PORT', 0))
+    cfg.misfire_grace_time = int(getenv('MISFIRE_GRACE_TIME', 1))
+    cfg.output_queue_size = int(getenv('OUTPUT_QUEUE_SIZE', 256))
+    cfg.reconciliation_interval = float(getenv('RECONCILIATION_INTERVAL', 300))
+    cfg.runtime = getenv('RUNTIME', 'threads')
+    if cfg.runtime not in ('asyncio', 'threads'):
+        raise ConfigurationError(f'Invalid RUNTIME: {cfg.runtime}')
+    if cfg.runtime == 'asyncio' and not cfg.docker_host.startswith('unix:'):
+        raise ConfigurationError('The asyncio runtime requires a unix socket.')
+    cfg.schedule_spread = float(getenv('SCHEDULE_SPREAD', 0))
+    if cfg.schedule_spread < 0:
+        raise ConfigurationError(f'Invalid SCHEDULE_SPREAD: {cfg.schedule_spread}')
+    cfg.service_concurrency = int(getenv('SERVICE_CONCURRENCY', 0))
     cfg.service_identifiers = split_string(
         getenv(
             'SERVICE_ID_LABELS', 'com.docker.compose.project,com.docker.compose.service'
         )
     )
     cfg.stderr_level = logging.getLevelName(getenv('STDERR_LEVEL', 'NOTSET'))
+    cfg.timings_file = getenv('TIMINGS_FILE', '')
     cfg.timezone = getenv('TIMEZONE', 'UTC').replace(' ', '_')
     cfg.client = _check_docker_api(
         docker.from_env(
             version='auto',
             timeout=cfg.client_timeout,
             environment=local_environment,
+            # the job executors, the inspection workers, the events' reader, the main
+            # thread, the reconciler and the watcher of executions may use a
+            # connection at the same time, the threads that handle outputs and serve
+            # metrics don't use the client
+            max_pool_size=cfg.job_executor_pool_size + cfg.inspection_workers + 4,
         )
     )
 
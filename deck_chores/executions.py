@@ -0,0 +1,304 @@
+import logging
+import selectors
+import socket
+from collections import Counter
+from collections.abc import Callable, Mapping
+from queue import Full, Queue
+from threading import Lock, Thread
+from time import perf_counter
+from typing import Any, Final, Optional
+
+from docker.constants import STREAM_HEADER_SIZE_BYTES
+from docker.utils.socket import read as read_socket
+
+from deck_chores import admission, metrics
+from deck_chores.config import cfg
+from deck_chores.indexes import container_name
+from deck_chores.utils import log
+
+
+####
+
+
+# the output that is collected for an execution's structured record is kept in memory
+# until the execution ends, hence it's capped unless the job defines a limit
+COLLECTED_OUTPUT_LIMIT: Final = 2**20
+
+
+class CapturedOutput:
+    """Logs the lines of an execution's output as they arrive. Output beyond the limit
+    of bytes is consumed but dropped, hence at most one incomplete line up to that
+    size is kept in memory. With ``collect`` the lines are kept instead, to be logged
+    as a field of the execution's record. The ``prefix`` identifies the execution in
+    each logged line, as the outputs of concurrent executions interleave."""
+
+    def __init__(
+        self, limit: Optional[int] = None, collect: bool = False, prefix: str = ''
+    ):
+        self.buffer = b''
+        self.lines = 0
+        self.omitted = 0
+        self.prefix = prefix
+        self.remaining = limit
+        self.collected: Optional[list[str]] = [] if collect else None
+
+    def feed(self, chunk: bytes):
+        if self.remaining is not None:
+            if len(chunk) > self.remaining:
+                self.omitted += len(chunk) - self.remaining
+                chunk = chunk[: self.remaining]
+            self.remaining -= len(chunk)
+
+        *lines, self.buffer = (self.buffer + chunk).split(b'\n')
+        for line in lines:
+            self.log(line)
+
+    def close(self):
+        if self.buffer:
+            self.log(self.buffer)
+            self.buffer = b''
+        if self.collected is not None:
+            return
+        if self.omitted:
+            self.log(f"== TRUNCATED, {self.omitted} bytes omitted ==".encode())
+        if self.lines:
+            log.info(f"{self.prefix}== END of captured stdout & stderr ====")
+
+    def log(self, line: bytes):
+        self.lines += 1
+        if self.collected is not None:
+            self.collected.append(line.decode(errors='replace').rstrip('\r'))
+            return
+        if self.lines == 1:
+            log.info(f"{self.prefix}== BEGIN of captured stdout & stderr ==")
+        log.info(self.prefix + line.decode(errors='replace').rstrip('\r'))
+
+
+def captured_output(
+    definition: Mapping[str, Any], name: Optional[str] = None
+) -> CapturedOutput:
+    """Returns the output capture for an execution, the container's ``name`` can be
+    passed if it's at hand."""
+    limit = definition.get('output_limit')
+    if cfg.logformat != 'json':
+        if name is None:
+            name = container_name(definition['container_id'])
+        return CapturedOutput(limit, prefix=f"{name}: {definition['job_name']}: ")
+    if limit is None:
+        limit = COLLECTED_OUTPUT_LIMIT
+    return CapturedOutput(limit, collect=True)
+
+
+def log_exit_code(
+    definition: Mapping[str, Any],
+    exit_code: int,
+    output: Optional[CapturedOutput] = None,
+):
+    """Logs one record per execution. Its details are passed as fields for structured
+    formats, including the output if it was collected."""
+    metrics.increment("deck_chores_job_executions_total", exit_code=str(exit_code))
+    fields = {
+        'job_id': definition.get('job_id'),
+        'job_name': definition.get('job_name'),
+        'container_id': definition['container_id'],
+        'command': definition['command'],
+        'exit_code': exit_code,
+    }
+    if output is not None and output.collected is not None:
+        fields['output'] = '\n'.join(output.collected)
+        fields['output_omitted_bytes'] = output.omitted
+    log.log(
+        logging.INFO if exit_code == 0 else logging.CRITICAL,
+        'Command `%s` in container %s finished with exit code %s.',
+        definition["command"],
+        definition["container_id"],
+        exit_code,
+        extra=fields,
+    )
+
+
+def record_run_time(job_id: str, seconds: float):
+    metrics.observe("deck_chores_execution_seconds", seconds)
+    metrics.record_timing("run_time", job_id, seconds)
+
+
+####
+
+
+_output_lock: Final = Lock()
+_output_queue: Optional[Queue] = None
+
+
+def handle_output(function: Callable, *args: Any, block: bool = True) -> bool:
+    """Passes the handling of executions' outputs and their completions to a
+    dedicated thread, hence the decoding and logging of large outputs doesn't delay
+    the threads or the event loop that run jobs. When the bounded queue is full, the
+    caller waits or ``False`` is returned if it must not block. Without a queue size
+    the function is called immediately."""
+    if not cfg.output_queue_size:
+        function(*args)
+        return True
+
+    global _output_queue
+    with _output_lock:
+        if _output_queue is None:
+            _output_queue = Queue(maxsize=cfg.output_queue_size)
+            Thread(
+                target=handle_outputs,
+                args=(_output_queue,),
+                name="output-handler",
+                daemon=True,
+            ).start()
+
+    try:
+        _output_queue.put((function, args), block=block)
+    except Full:
+        return False
+    return True
+
+
+def handle_outputs(queue: Queue):
+    while True:
+        function, args = queue.get()
+        try:
+            function(*args)
+        except Exception:
+            log.exception("Failed to handle an execution's output:")
+        finally:
+            queue.task_done()
+
+
+def join_output_handling():
+    """Waits until all queued outputs are handled."""
+    if _output_queue is not None:
+        _output_queue.join()
+
+
+####
+
+
+class WatchedExecution:
+    def __init__(self, definition: Mapping[str, Any], exec_id: str, sock: Any):
+        self.definition = definition
+        self.exec_id = exec_id
+        self.socket = sock
+        self.started_at = perf_counter()
+        self.frames = b''
+        self.output = captured_output(definition)
+
+    def feed(self, chunk: bytes):
+        """Passes the payloads of the multiplexed stream's complete frames on."""
+        self.frames += chunk
+        while len(self.frames) >= STREAM_HEADER_SIZE_BYTES:
+            size = int.from_bytes(self.frames[4:STREAM_HEADER_SIZE_BYTES], 'big')
+            end = STREAM_HEADER_SIZE_BYTES + size
+            if len(self.frames) < end:
+                break
+            handle_output(self.output.feed, self.frames[STREAM_HEADER_SIZE_BYTES:end])
+            self.frames = self.frames[end:]
+
+
+READ_SIZE: Final = 2**16
+
+selector: Final = selectors.DefaultSelector()
+# a write to this pair's end interrupts the selection, so that newly registered
+# sockets are considered
+_wakeup_receiver, _wakeup_sender = socket.socketpair()
+_wakeup_receiver.setblocking(False)
+selector.register(_wakeup_receiver, selectors.EVENT_READ)
+
+_watcher_lock: Final = Lock()
+_watcher: Optional[Thread] = None
+_running_executions: Final[Counter[str]] = Counter()
+
+
+def reserve_execution(job_id: str, maximum: int) -> bool:
+    """Counts an execution of the job as running unless the maximum is reached."""
+    with _watcher_lock:
+        if _running_executions[job_id] >= maximum:
+            return False
+        _running_executions[job_id] += 1
+        return True
+
+
+def running_executions(job_id: str) -> int:
+    return _running_executions[job_id]
+
+
+def release_execution(job_id: str):
+    with _watcher_lock:
+        _running_executions[job_id] -= 1
+        if _running_executions[job_id] <= 0:
+            del _running_executions[job_id]
+
+
+def watch(definition: Mapping[str, Any], exec_id: str, sock: Any):
+    """Hands a reserved execution's attached socket over to the watcher thread that
+    logs its output and exit code. Thus an executor is only occupied while the
+    execution is started."""
+    global _watcher
+    with _watcher_lock:
+        if _watcher is None:
+            _watcher = Thread(target=watch_executions, name="exec-watcher", daemon=True)
+            _watcher.start()
+    selector.register(
+        sock, selectors.EVENT_READ, WatchedExecution(definition, exec_id, sock)
+    )
+    _wakeup_sender.send(b'\0')
+
+
+def watch_executions():
+    while True:
+        for key, _ in selector.select():
+            if key.fileobj is _wakeup_receiver:
+                _wakeup_receiver.recv(READ_SIZE)
+            else:
+                read_execution(key.data)
+
+
+def read_execution(execution: WatchedExecution):
+    try:
+        chunk = read_socket(execution.socket, READ_SIZE)
+        # decrypted data may be buffered in a TLS socket without being signaled
+        while chunk and getattr(execution.socket, 'pending', lambda: 0)():
+            chunk += read_socket(execution.socket, READ_SIZE) or b''
+    except OSError as e:
+        log.error(f"Failed to read the output of exec {execution.exec_id}: {e}")
+        chunk = b''
+
+    if chunk:
+        execution.feed(chunk)
+    elif chunk is not None:  # the stream ended
+        finish_execution(execution)
+
+
+def finish_execution(execution: WatchedExecution):
+    selector.unregister(execution.socket)
+    execution.socket.close()
+    release_execution(execution.definition['job_id'])
+    admission.release(execution.definition['job_id'], handed_over=True)
+
+    handle_output(execution.output.close)
+    record_run_time(
+        execution.definition['job_id'], perf_counter() - execution.started_at
+    )
+    try:
+        exit_code = cfg.client.api.exec_inspect(execution.exec_id)['ExitCode']
+    except Exception as e:
+        log.error(f"Failed to inspect exec {execution.exec_id}: {e}")
+    else:
+        handle_output(log_exit_code, execution.definition, exit_code, execution.output)
+
+
+__all__ = (
+    CapturedOutput.__name__,
+    captured_output.__name__,
+    handle_output.__name__,
+    join_output_handling.__name__,
+    log_exit_code.__name__,
+    record_run_time.__name__,
+    release_execution.__name__,
+    reserve_execution.__name__,
+    running_executions.__name__,
+    watch.__name__,
+)
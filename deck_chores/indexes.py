@@ -1,7 +1,10 @@
+from collections.abc import Iterable
 from functools import lru_cache
 from types import MappingProxyType
 from typing import Final
 
+from docker.models.containers import Container
+
 from deck_chores.config import cfg, CONTAINER_CACHE_SIZE
 from deck_chores.utils import log
 
@@ -9,8 +12,25 @@ from deck_chores.utils import log
 ####
 
 
+_prefetched_attributes: Final[dict[str, dict]] = {}
+prefetched_attributes: Final = MappingProxyType(_prefetched_attributes)
+
+
+def prefetch_attributes(containers: Iterable[Container]):
+    """Keeps the attributes of sparsely listed containers, so that their names and
+    labels don't need to be queried one by one."""
+    for container in containers:
+        _prefetched_attributes[container.id] = container.attrs
+
+
+def discard_prefetched_attributes():
+    _prefetched_attributes.clear()
+
+
 @lru_cache(maxsize=CONTAINER_CACHE_SIZE)
 def container_name(container_id: str) -> str:
+    if (attributes := prefetched_attributes.get(container_id)) is not None:
+        return attributes["Names"][0].lstrip("/")
     return cfg.client.containers.get(container_id).name
 
 
@@ -28,7 +48,7 @@ def lock_service(service_id: tuple[str, ...], container_id: str):
     _service_locks_by_service_id[service_id] = container_id
     assert container_id not in service_locks_by_container_id
     _service_locks_by_container_id[container_id] = service_id
-    log.debug(f"Added lock for service {service_id} on container {container_id}.")
+    log.debug("Added lock for service %s on container %s.", service_id, container_id)
 
 
 def reassign_service_lock(old_container_id: str, new_container_id: str):
@@ -39,8 +59,10 @@ def reassign_service_lock(old_container_id: str, new_container_id: str):
     assert service_id in service_locks_by_service_id
     _service_locks_by_service_id[service_id] = new_container_id
     log.debug(
-        f"Reassigned lock for service {service_id} from container {old_container_id} "
-        f"to {new_container_id}."
+        "Reassigned lock for service %s from container %s to %s.",
+        service_id,
+        old_container_id,
+        new_container_id,
     )
 
 
@@ -49,13 +71,82 @@ def unlock_service(container_id: str):
     if service_id is None:
         return
     _service_locks_by_service_id.pop(service_id)
-    log.debug(f"Removed lock for service {service_id} on container {container_id}.")
+    log.debug("Removed lock for service %s on container %s.", service_id, container_id)
+
+
+####
+
+
+_container_id_by_job_id: Final[dict[str, str]] = {}
+_job_ids_by_container_id: Final[dict[str, set[str]]] = {}
+job_ids_by_container_id: Final = MappingProxyType(_job_ids_by_container_id)
+
+
+def register_job(job_id: str, container_id: str):
+    unregister_job(job_id)
+    _container_id_by_job_id[job_id] = container_id
+    _job_ids_by_container_id.setdefault(container_id, set()).add(job_id)
+
+
+def unregister_job(job_id: str):
+    container_id = _container_id_by_job_id.pop(job_id, None)
+    if container_id is None:
+        return
+    job_ids = _job_ids_by_container_id[container_id]
+    job_ids.discard(job_id)
+    if not job_ids:
+        del _job_ids_by_container_id[container_id]
+
+
+def unregister_all_jobs():
+    _container_id_by_job_id.clear()
+    _job_ids_by_container_id.clear()
+
+
+def reassign_job_ids(old_container_id: str, new_container_id: str):
+    job_ids = _job_ids_by_container_id.pop(old_container_id, set())
+    for job_id in job_ids:
+        _container_id_by_job_id[job_id] = new_container_id
+    if job_ids:
+        _job_ids_by_container_id.setdefault(new_container_id, set()).update(job_ids)
+
+
+####
+
+
+# the states of containers as reported by the listing at startup and the daemon's
+# events since then, only running and paused ones are recorded
+_container_states: Final[dict[str, str]] = {}
+container_states: Final = MappingProxyType(_container_states)
+
+
+def set_container_state(container_id: str, state: str):
+    _container_states[container_id] = state
+
+
+def discard_container_state(container_id: str):
+    _container_states.pop(container_id, None)
+
+
+####
 
 
 __all__ = (
+    "container_states",
+    "job_ids_by_container_id",
+    "prefetched_attributes",
     "service_locks_by_container_id",
     "service_locks_by_service_id",
+    container_name.__name__,
+    discard_container_state.__name__,
+    discard_prefetched_attributes.__name__,
     lock_service.__name__,
+    prefetch_attributes.__name__,
+    reassign_job_ids.__name__,
     reassign_service_lock.__name__,
+    register_job.__name__,
+    set_container_state.__name__,
     unlock_service.__name__,
+    unregister_all_jobs.__name__,
+    unregister_job.__name__,
 )
@@ -1,39 +1,110 @@
-import logging
-from collections.abc import Iterator, Mapping
-from typing import Final
+from asyncio import AbstractEventLoop
+from collections import Counter
+from collections import deque
+from collections.abc import Awaitable, Callable, Iterator, Mapping
+from datetime import datetime, timedelta, timezone
+from threading import Lock
+from time import perf_counter, time
+from typing import Final, Optional
+from uuid import UUID
 
 from apscheduler import events
-from apscheduler.executors.pool import ThreadPoolExecutor
 from apscheduler.job import Job
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.schedulers.base import BaseScheduler
+from apscheduler.triggers.base import BaseTrigger
+from apscheduler.triggers.date import DateTrigger
 from apscheduler.util import undefined as undefined_runtime
 
+from deck_chores import metrics
+from deck_chores.admission import (
+    AdmittingAsyncIOExecutor,
+    AdmittingThreadPoolExecutor,
+    discard_queued,
+    hand_over,
+)
 from deck_chores.config import cfg
-from deck_chores.indexes import container_name
+from deck_chores.executions import (
+    captured_output,
+    handle_output,
+    log_exit_code,
+    record_run_time,
+    release_execution,
+    reserve_execution,
+    watch,
+)
+from deck_chores.indexes import (
+    container_name,
+    container_states,
+    job_ids_by_container_id,
+    register_job,
+    unregister_all_jobs,
+    unregister_job,
+)
+from deck_chores.jobstores import SQLiteJobStore
+from deck_chores.parsers import create_trigger
 from deck_chores.utils import generate_id, log
 
 
 ####
 
 
-scheduler: Final = BackgroundScheduler()
+scheduler: BaseScheduler = BackgroundScheduler()
+
+# the checks are counted by the executors' threads
+state_check_statistics: Final[Counter[str]] = Counter()
+_state_check_lock: Final = Lock()
+
+# the times at which the running executions of jobs started
+_start_times: Final[dict[str, deque[float]]] = {}
+
 
+def use_event_loop(
+    event_loop: AbstractEventLoop, function: Callable[..., Awaitable[int]]
+):
+    """Replaces the scheduler with one that runs the jobs' executions as the given
+    coroutine function on the event loop. This must happen before any job is added."""
+    global job_function, scheduler
+    job_function = function
+    scheduler = AsyncIOScheduler(event_loop=event_loop)
 
-def start_scheduler():
-    job_executors = {"default": ThreadPoolExecutor(cfg.job_executor_pool_size)}
+
+def start_scheduler(paused: bool = False):
+    if isinstance(scheduler, AsyncIOScheduler):
+        job_executors = {"default": AdmittingAsyncIOExecutor()}
+    else:
+        job_executors = {
+            "default": AdmittingThreadPoolExecutor(cfg.job_executor_pool_size)
+        }
+    job_stores = {"default": SQLiteJobStore(cfg.job_store)} if cfg.job_store else {}
+    # runs that were missed while deck-chores wasn't running are executed once if
+    # they are within the grace time
+    job_defaults = {"coalesce": True, "misfire_grace_time": cfg.misfire_grace_time}
     logger = log if cfg.debug else None
-    scheduler.configure(executors=job_executors, logger=logger, timezone=cfg.timezone)
+    scheduler.configure(
+        executors=job_executors,
+        jobstores=job_stores,
+        job_defaults=job_defaults,
+        logger=logger,
+        timezone=cfg.timezone,
+    )
     scheduler.add_listener(on_error, events.EVENT_JOB_ERROR)
     scheduler.add_listener(on_executed, events.EVENT_JOB_EXECUTED)
     scheduler.add_listener(on_max_instances, events.EVENT_JOB_MAX_INSTANCES)
     scheduler.add_listener(on_missed, events.EVENT_JOB_MISSED)
-    scheduler.start()
+    scheduler.add_listener(on_submitted, events.EVENT_JOB_SUBMITTED)
+    scheduler.add_listener(
+        on_removed, events.EVENT_JOB_REMOVED | events.EVENT_ALL_JOBS_REMOVED
+    )
+    scheduler.start(paused=paused)
 
 
 ####
 
 
 def on_max_instances(event: events.JobSubmissionEvent):
+    metrics.increment("deck_chores_job_runs_skipped_total")
     job = scheduler.get_job(event.job_id)
     definition = job.kwargs
     log.info(
@@ -43,28 +114,20 @@ def on_max_instances(event: events.JobSubmissionEvent):
     )
 
 
-def on_executed(event: events.JobExecutionEvent):
-    job = scheduler.get_job(event.job_id)
-    if job is None or job.id == 'container_inspection':
-        return
+def on_submitted(event: events.JobSubmissionEvent):
+    metrics.observe(
+        "deck_chores_scheduler_lag_seconds",
+        (datetime.now(timezone.utc) - event.scheduled_run_times[-1]).total_seconds(),
+    )
 
-    definition = job.kwargs
-    exit_code, response_lines = event.retval
-    response_lines = response_lines.decode().splitlines()
 
-    log.log(
-        logging.INFO if exit_code == 0 else logging.CRITICAL,
-        f'Command `{definition["command"]}` in container {definition["container_id"]} '
-        f'finished with exit code {exit_code}.',
-    )
-    if response_lines:
-        log.info("== BEGIN of captured stdout & stderr ==")
-        for line in response_lines:
-            log.info(line)
-        log.info("== END of captured stdout & stderr ====")
+def on_executed(event: events.JobExecutionEvent):
+    record_start_delay(event)
 
 
 def on_error(event: events.JobExecutionEvent):
+    record_start_delay(event)
+    metrics.increment("deck_chores_job_errors_total")
     definition = scheduler.get_job(event.job_id).kwargs
     log.critical(
         f'An exception in deck-chores occurred while executing'
@@ -74,6 +137,12 @@ def on_error(event: events.JobExecutionEvent):
 
 
 def on_missed(event: events.JobExecutionEvent):
+    metrics.increment("deck_chores_job_runs_missed_total")
+    metrics.record_timing(
+        "missed_by",
+        event.job_id,
+        (datetime.now(timezone.utc) - event.scheduled_run_time).total_seconds(),
+    )
     definition = scheduler.get_job(event.job_id).kwargs
     log.warning(
         f'Missed execution of {definition["job_name"]} in container '
@@ -81,39 +150,122 @@ def on_missed(event: events.JobExecutionEvent):
     )
 
 
+def on_removed(event: events.JobEvent):
+    if event.code == events.EVENT_ALL_JOBS_REMOVED:
+        unregister_all_jobs()
+        metrics.discard_job_timings()
+        _start_times.clear()
+        discard_queued()
+    else:
+        unregister_job(event.job_id)
+        metrics.discard_job_timings(event.job_id)
+        _start_times.pop(event.job_id, None)
+        discard_queued(event.job_id)
+
+
+def record_start(job_id: str):
+    """Is called by job functions when they start, so that the delay after the
+    scheduled time is recorded when the execution's end is signaled."""
+    _start_times.setdefault(job_id, deque()).append(time())
+
+
+def record_start_delay(event: events.JobExecutionEvent):
+    # concurrent executions of a job end in the order they started most likely
+    if not (start_times := _start_times.get(event.job_id)):
+        return
+    started_at = start_times.popleft()
+    metrics.record_timing(
+        "start_delay", event.job_id, started_at - event.scheduled_run_time.timestamp()
+    )
+
+
 ####
 
 
-def exec_job(**definition) -> tuple[int, bytes]:
-    job_id = definition['job_id']
+def exec_job(**definition) -> Optional[int]:
+    record_start(definition['job_id'])
     container_id = definition['container_id']
     log.info(f"{container_name(container_id)}: Executing '{definition['job_name']}'.")
 
-    # some sanity checks, to be removed eventually
-    assert scheduler.get_job(job_id) is not None
-    if cfg.client.containers.list(filters={'id': container_id, 'status': 'paused'}):
-        raise AssertionError('Container is paused.')
+    if (state := cached_container_state(container_id)) is None:
+        # a sparse listing is the cheapest request that includes the state
+        containers = cfg.client.containers.list(
+            all=True, filters={'id': container_id}, sparse=True
+        )
+        state = containers[0].status if containers else None
+    assert_executable_state(state)
 
-    if not cfg.client.containers.list(
-        filters={'id': container_id, 'status': 'running'}
-    ):
-        assert scheduler.get_job(job_id) is None
+    watched = cfg.job_execution == 'watched'
+    if watched and not reserve_execution(definition['job_id'], definition['max']):
+        metrics.increment("deck_chores_job_runs_skipped_total")
+        log.info(
+            f"{container_name(container_id)}: "
+            f"Not running {definition['job_name']}, "
+            f"maximum instances of {definition['max']} are still running."
+        )
+        return None
+
+    api = cfg.client.api
+    started_at = perf_counter()
+    try:
+        exec_id = api.exec_create(
+            container_id,
+            cmd=definition['command'],
+            user=definition['user'],
+            environment=definition['environment'],
+            workdir=definition.get('workdir'),
+        )['Id']
+        if watched:
+            sock = api.exec_start(exec_id, socket=True)
+            hand_over(definition['job_id'])
+            watch(definition, exec_id, sock)
+            return None
+    except BaseException:
+        if watched:
+            release_execution(definition['job_id'])
+        raise
+
+    output = captured_output(definition)
+    for chunk in api.exec_start(exec_id, stream=True):
+        handle_output(output.feed, chunk)
+    handle_output(output.close)
+    record_run_time(definition['job_id'], perf_counter() - started_at)
+    exit_code = api.exec_inspect(exec_id)['ExitCode']
+    handle_output(log_exit_code, definition, exit_code, output)
+    return exit_code
+
+
+def cached_container_state(container_id: str) -> Optional[str]:
+    """Returns the container's state as recorded from the daemon's events or ``None``
+    if it must be verified with a request to the daemon."""
+    if cfg.container_state_checks == 'cached':
+        if (state := container_states.get(container_id)) is not None:
+            count_state_check('cached')
+            return state
+    count_state_check('verified')
+    return None
+
+
+def count_state_check(kind: str):
+    with _state_check_lock:
+        state_check_statistics[kind] += 1
+
+
+def assert_executable_state(state: Optional[str]):
+    if state == 'paused':
+        raise AssertionError('Container is paused.')
+    if state != 'running':
         raise AssertionError('Container is not running.')
-    # end of sanity checks
 
-    return cfg.client.containers.get(container_id).exec_run(
-        cmd=definition['command'],
-        user=definition['user'],
-        environment=definition['environment'],
-        workdir=definition.get('workdir'),
-    )
+
+job_function: Callable = exec_job
 
 
 ####
 
 
 def add(container_id: str, definitions: Mapping[str, dict], paused: bool = False):
-    log.debug(f'Adding jobs to container {container_id}.')
+    log.debug('Adding jobs to container %s.', container_id)
 
     for job_name, definition in definitions.items():
         job_id = generate_id(*definition.get("service_id") or (container_id,), job_name)
@@ -123,16 +275,18 @@ def add(container_id: str, definitions: Mapping[str, dict], paused: bool = False
         )
 
         trigger_class, trigger_config = definition['trigger']
-        trigger_kwargs = {'timezone': definition['timezone']}
-        if jitter_value := definition.get('jitter') is not None:
-            trigger_kwargs['jitter'] = jitter_value
+        trigger = create_trigger(
+            trigger_class,
+            trigger_config,
+            definition['timezone'],
+            definition.get('jitter'),
+        )
+        if cfg.schedule_spread and trigger_class is not DateTrigger:
+            trigger = SpreadTrigger(trigger, spread_offset(job_id, cfg.schedule_spread))
 
         scheduler.add_job(
-            func=exec_job,
-            trigger=trigger_class(
-                *trigger_config,
-                **trigger_kwargs,
-            ),
+            func=job_function,
+            trigger=trigger,
             kwargs=definition,
             id=job_id,
             name=job_name,
@@ -140,6 +294,7 @@ def add(container_id: str, definitions: Mapping[str, dict], paused: bool = False
             next_run_time=None if paused else undefined_runtime,
             replace_existing=True,
         )
+        register_job(job_id, container_id)
         log.info(
             f"{container_name(container_id)}: Added "
             + ("paused " if paused else "")
@@ -147,19 +302,55 @@ def add(container_id: str, definitions: Mapping[str, dict], paused: bool = False
         )
 
 
+class SpreadTrigger(BaseTrigger):
+    """Delays the fire times of another trigger by a fixed offset."""
+
+    def __init__(self, trigger: BaseTrigger, offset: float):
+        self.trigger = trigger
+        self.offset = timedelta(seconds=offset)
+
+    def get_next_fire_time(self, previous_fire_time, now):
+        if previous_fire_time is not None:
+            previous_fire_time -= self.offset
+        next_fire_time = self.trigger.get_next_fire_time(
+            previous_fire_time, now - self.offset
+        )
+        return None if next_fire_time is None else next_fire_time + self.offset
+
+    def __str__(self):
+        return f"{self.trigger}, spread by {self.offset}"
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__} "
+            f"({self.trigger!r}, offset='{self.offset}')>"
+        )
+
+
+def spread_offset(job_id: str, window: float) -> float:
+    """Derives an offset within the window from a job's id, hence the runs of jobs
+    with the same trigger are scattered across the window roughly uniformly and each
+    job keeps its offset across restarts."""
+    return UUID(job_id).int % 10**6 / 10**6 * window
+
+
 ####
 
 
 def get_jobs_for_container(container_id: str) -> Iterator[Job]:
     assert container_id, container_id
-    for job in scheduler.get_jobs():
-        if job.kwargs['container_id'] == container_id:
+    # the index is copied as jobs may be removed while the caller iterates
+    for job_id in tuple(job_ids_by_container_id.get(container_id, ())):
+        job = scheduler.get_job(job_id)
+        if job is not None:
             yield job
 
 
 __all__ = (
     "scheduler",
     "start_scheduler",
+    record_start.__name__,
+    use_event_loop.__name__,
     add.__name__,
     get_jobs_for_container.__name__,
 )
@@ -0,0 +1,136 @@
+import pickle
+import sqlite3
+from threading import Lock
+from typing import Final, Optional
+
+from apscheduler.job import Job
+from apscheduler.jobstores.base import BaseJobStore, ConflictingIdError, JobLookupError
+from apscheduler.util import datetime_to_utc_timestamp, utc_timestamp_to_datetime
+
+
+####
+
+
+SCHEMA: Final = (
+    "CREATE TABLE IF NOT EXISTS jobs "
+    "(id TEXT PRIMARY KEY, next_run_time REAL, job_state BLOB NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS jobs_next_run_time ON jobs (next_run_time)",
+)
+
+
+class SQLiteJobStore(BaseJobStore):
+    """Stores the jobs in an SQLite database file with the same layout as
+    APScheduler's SQLAlchemyJobStore, but without depending on SQLAlchemy."""
+
+    def __init__(self, path: str, pickle_protocol: int = pickle.HIGHEST_PROTOCOL):
+        super().__init__()
+        self.path = path
+        self.pickle_protocol = pickle_protocol
+        self.connection: Optional[sqlite3.Connection] = None
+        # the connection is shared by the scheduler's and the event handling threads
+        self.lock = Lock()
+
+    def start(self, scheduler, alias):
+        super().start(scheduler, alias)
+        self.connection = sqlite3.connect(
+            self.path, check_same_thread=False, isolation_level=None
+        )
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+
+    def shutdown(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def lookup_job(self, job_id: str) -> Optional[Job]:
+        rows = self._query("SELECT id, job_state FROM jobs WHERE id = ?", (job_id,))
+        jobs = self._reconstitute_jobs(rows)
+        return jobs[0] if jobs else None
+
+    def get_due_jobs(self, now) -> list[Job]:
+        return self._reconstitute_jobs(
+            self._query(
+                "SELECT id, job_state FROM jobs WHERE next_run_time <= ? "
+                "ORDER BY next_run_time",
+                (datetime_to_utc_timestamp(now),),
+            )
+        )
+
+    def get_next_run_time(self):
+        rows = self._query(
+            "SELECT next_run_time FROM jobs WHERE next_run_time IS NOT NULL "
+            "ORDER BY next_run_time LIMIT 1"
+        )
+        return utc_timestamp_to_datetime(rows[0][0]) if rows else None
+
+    def get_all_jobs(self) -> list[Job]:
+        jobs = self._reconstitute_jobs(
+            self._query("SELECT id, job_state FROM jobs ORDER BY next_run_time")
+        )
+        self._fix_paused_jobs_sorting(jobs)
+        return jobs
+
+    def add_job(self, job: Job):
+        try:
+            self._query(
+                "INSERT INTO jobs (id, next_run_time, job_state) VALUES (?, ?, ?)",
+                (job.id, *self._serialize(job)),
+            )
+        except sqlite3.IntegrityError:
+            raise ConflictingIdError(job.id)
+
+    def update_job(self, job: Job):
+        if not self._modify(
+            "UPDATE jobs SET next_run_time = ?, job_state = ? WHERE id = ?",
+            (*self._serialize(job), job.id),
+        ):
+            raise JobLookupError(job.id)
+
+    def remove_job(self, job_id: str):
+        if not self._modify("DELETE FROM jobs WHERE id = ?", (job_id,)):
+            raise JobLookupError(job_id)
+
+    def remove_all_jobs(self):
+        self._query("DELETE FROM jobs")
+
+    def _query(self, statement: str, parameters: tuple = ()) -> list[tuple]:
+        assert self.connection is not None
+        with self.lock:
+            return self.connection.execute(statement, parameters).fetchall()
+
+    def _modify(self, statement: str, parameters: tuple) -> int:
+        assert self.connection is not None
+        with self.lock:
+            return self.connection.execute(statement, parameters).rowcount
+
+    def _serialize(self, job: Job) -> tuple[Optional[float], bytes]:
+        return (
+            datetime_to_utc_timestamp(job.next_run_time),
+            pickle.dumps(job.__getstate__(), self.pickle_protocol),
+        )
+
+    def _reconstitute_jobs(self, rows: list[tuple]) -> list[Job]:
+        jobs, failed_job_ids = [], []
+        for job_id, job_state in rows:
+            try:
+                job = Job.__new__(Job)
+                job.__setstate__(pickle.loads(job_state))
+            except Exception:
+                self._logger.exception(f"Unable to restore job {job_id}, removing it.")
+                failed_job_ids.append(job_id)
+                continue
+            job._scheduler = self._scheduler
+            job._jobstore_alias = self._alias
+            jobs.append(job)
+
+        for job_id in failed_job_ids:
+            self._modify("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+        return jobs
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} (path={self.path})>"
+
+
+__all__ = (SQLiteJobStore.__name__,)
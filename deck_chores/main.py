@@ -1,26 +1,49 @@
+import asyncio
 import json
 import os
 import sys
-from datetime import datetime, timedelta, timezone
+from collections import Counter
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty, Queue
 from signal import signal, SIGINT, SIGTERM, SIGUSR1
+from threading import Thread
+from time import perf_counter, sleep, time_ns
 from typing import Final, Optional
 
 from apscheduler.schedulers import SchedulerNotRunningError
-from dateutil.parser import isoparse as parse_iso_timestamp
 from docker.models.containers import Container
 from fasteners import InterProcessLock
 
-from deck_chores import __version__, jobs
+from deck_chores import __version__, admission, jobs, metrics
 from deck_chores.config import cfg, generate_config, ConfigurationError
+from deck_chores.executions import join_output_handling
 from deck_chores.indexes import (
     container_name,
+    discard_container_state,
+    discard_prefetched_attributes,
+    container_states,
+    job_ids_by_container_id,
     lock_service,
+    prefetch_attributes,
+    reassign_job_ids,
     reassign_service_lock,
+    register_job,
+    set_container_state,
     unlock_service,
     service_locks_by_service_id,
     service_locks_by_container_id,
 )
-from deck_chores.parsers import job_config_validator, parse_labels
+from deck_chores.parsers import (
+    cached_trigger,
+    image_definition_labels,
+    job_config_validator,
+    labels_fingerprint,
+    parse_flags_option,
+    parse_labels,
+    ParsedLabels,
+    validate_job_definition,
+)
 from deck_chores.utils import (
     DEBUG,
     log,
@@ -33,6 +56,38 @@ from deck_chores.utils import (
 
 lock: Final = InterProcessLock('/tmp/deck-chores.lock')
 
+# the daemon omits all other events, a filter for the label namespace isn't possible
+# as label filters can only match complete keys
+EVENTS_FILTERS: Final = {
+    "type": ["container", "image"],
+    "event": ["start", "die", "pause", "unpause", "delete"],
+}
+# when the queue is full, the reader stops to consume the stream from the daemon
+EVENTS_QUEUE_SIZE: Final = 1024
+
+event_statistics: Final[Counter[str]] = Counter()
+
+# the functions that cache containers' and images' properties
+CACHED_FUNCTIONS: Final = (
+    container_name,
+    parse_labels,
+    image_definition_labels,
+    validate_job_definition,
+    cached_trigger,
+)
+
+# the maximum number of containers whose states are corrected per reconciliation
+RECONCILIATION_LIMIT: Final = 64
+# containers with events that were received shortly before a reconciliation's listing
+# are considered in the next one, as the listing may not reflect them yet
+RECONCILIATION_TIME_MARGIN: Final = 10**9
+
+# the delay before the second attempt to reconnect to the daemon's events
+RECONNECT_BASE_DELAY: Final = 0.5
+
+# the daemon's time of the last handled event per container
+_event_times: Final[dict[str, int]] = {}
+
 
 def there_is_another_deck_chores_container() -> bool:
     matched_containers = 0
@@ -59,10 +114,74 @@ def sigterm_handler(signum, frame):  # pragma: nocover
 
 
 def sigusr1_handler(signum, frame):
+    # the report is compiled in another thread as the interrupted main thread may
+    # hold the locks of the reported data
+    Thread(target=report_state, name="reporter", daemon=True).start()
+
+
+def report_state():
     log.info("SIGUSR1 received, echoing all jobs.")
     for job in jobs.scheduler.get_jobs():
         log.info(f"ID: {job.id}   Next execution: {job.next_run_time}   Configuration:")
         log.info(job.kwargs)
+    for function in CACHED_FUNCTIONS:
+        log.info(f"Cache statistics of {function.__name__}: {function.cache_info()}")
+    log.info(f"Container state checks: {dict(jobs.state_check_statistics)}")
+    log.info(f"Event statistics: {dict(event_statistics)}")
+
+    timings = metrics.timings_report()
+    for kind, summaries in timings.items():
+        log.info(f"Timings of {kind.replace('_', ' ')}: {summaries['all']}")
+    for priority, summary in admission.queue_wait_report().items():
+        log.info(f"Queue waits of jobs with {priority} priority: {summary}")
+    if cfg.timings_file:
+        dump_timings(timings)
+
+
+def dump_timings(timings: dict):
+    try:
+        with open(cfg.timings_file, "w") as f:
+            json.dump(timings, f, indent=2)
+    except OSError as e:
+        log.error(f"Failed to dump the timings: {e}")
+    else:
+        log.info(f"Dumped the timings per job to {cfg.timings_file}.")
+
+
+####
+
+
+def serve_metrics():
+    if not cfg.metrics_port:
+        return
+
+    for name, attribute in (
+        ("deck_chores_cache_hits_total", "hits"),
+        ("deck_chores_cache_misses_total", "misses"),
+    ):
+        metrics.register_collector(
+            name,
+            "counter",
+            f"The {attribute} of the caches for containers' and images' properties.",
+            lambda attribute=attribute: (
+                (
+                    {"cache": function.__name__},
+                    getattr(function.cache_info(), attribute),
+                )
+                for function in CACHED_FUNCTIONS
+            ),
+        )
+    if cfg.runtime == "threads":
+        metrics.register_collector(
+            "deck_chores_job_executors",
+            "gauge",
+            "The size of the job executors' pool.",
+            lambda: (({}, cfg.job_executor_pool_size),),
+        )
+    metrics.serve(cfg.metrics_port)
+
+
+####
 
 
 signal(SIGINT, sigint_handler)
@@ -73,8 +192,12 @@ signal(SIGUSR1, sigusr1_handler)
 ####
 
 
-def process_started_container_labels(container_id: str, paused: bool = False):
-    service_id, flags, definitions = parse_labels(container_id)
+def process_started_container_labels(
+    container_id: str,
+    paused: bool = False,
+    parsed_labels: Optional[ParsedLabels] = None,
+):
+    service_id, flags, definitions = parsed_labels or parse_labels(container_id)
 
     if not definitions:
         return
@@ -83,7 +206,9 @@ def process_started_container_labels(container_id: str, paused: bool = False):
         other_container_id = service_locks_by_service_id.get(service_id)
         if other_container_id:
             log.debug(
-                f'Service id {service_id} is locked by container {other_container_id}.'
+                'Service id %s is locked by container %s.',
+                service_id,
+                other_container_id,
             )
             if cfg.client.containers.get(other_container_id).status == "paused":
                 assert reassign_jobs(other_container_id, consider_paused=False)
@@ -94,29 +219,90 @@ def process_started_container_labels(container_id: str, paused: bool = False):
     jobs.add(container_id, definitions, paused=paused)
 
 
-def inspect_running_containers() -> datetime:
+def inspect_running_containers():
     log.info("Inspecting running containers.")
-    last_event_time = datetime.now(timezone.utc)
-    containers = cfg.client.containers.list(ignore_removed=True, sparse=True)
+    # a sparse listing is one request that includes names, labels and states
+    process_running_containers(
+        cfg.client.containers.list(ignore_removed=True, sparse=True)
+    )
 
+
+def process_running_containers(containers: list[Container]):
+    started_at = perf_counter()
     for container in containers:
-        container_id = container.id
-        last_event_time = max(
-            last_event_time,
-            parse_iso_timestamp(
-                cfg.client.api.inspect_container(container_id)['State']['StartedAt']
-            ),
-        )
-        process_started_container_labels(
-            container_id, paused=container.status == 'paused'
-        )
+        set_container_state(container.id, container.status)
+    restored_container_ids = restore_jobs(containers)
+    containers = [c for c in containers if c.id not in restored_container_ids]
+    prefetch_attributes(containers)
 
-    log.debug('Finished inspection of running containers.')
+    try:
+        with ThreadPoolExecutor(
+            cfg.inspection_workers, thread_name_prefix="inspection"
+        ) as executor:
+            # the labels are parsed concurrently, but the results are processed one
+            # after another in the listing's order by this thread, that is the only
+            # one that alters the service locks
+            for container, parsed_labels in zip(
+                containers, executor.map(parse_labels, (c.id for c in containers))
+            ):
+                process_started_container_labels(
+                    container.id,
+                    paused=container.status == 'paused',
+                    parsed_labels=parsed_labels,
+                )
+    finally:
+        discard_prefetched_attributes()
+
+    log.info(
+        f"Inspected {len(containers)} running containers and restored the jobs of "
+        f"{len(restored_container_ids)} in {perf_counter() - started_at:.3f} seconds."
+    )
 
-    # the timezone info is removed here, because the object will be fed to docker-py
-    # (version 4.4.4 at the time of writing) which cannot process timezone aware
-    # datetime objects
-    return last_event_time.replace(tzinfo=None)
+
+def restore_jobs(containers: list[Container]) -> set[str]:
+    """Keeps the stored jobs of running containers whose labels' fingerprints are
+    unchanged, the other stored jobs are removed. The ids of the containers whose
+    jobs were kept are returned."""
+    containers_by_id = {c.id: c for c in containers}
+    fingerprints: dict[str, str] = {}
+    flags: dict[str, str] = {}
+    result = set()
+
+    for job in jobs.scheduler.get_jobs():
+        definition = job.kwargs
+        container_id = definition["container_id"]
+        container = containers_by_id.get(container_id)
+        if container is not None and container_id not in fingerprints:
+            labels = container.attrs["Labels"] or {}
+            fingerprints[container_id] = labels_fingerprint(
+                labels, container.attrs["ImageID"]
+            )
+            flags[container_id] = parse_flags_option(
+                {k: v for k, v in labels.items() if k.startswith(cfg.label_ns)}
+            )
+        if container is None or (
+            definition.get("fingerprint") != fingerprints[container_id]
+        ):
+            log.debug("Removing stored job %s.", job.id)
+            job.remove()
+            continue
+
+        register_job(job.id, container_id)
+        service_id = definition.get("service_id")
+        # as in process_started_container_labels
+        if (
+            service_id
+            and "service" in flags[container_id]
+            and service_id not in service_locks_by_service_id
+        ):
+            lock_service(service_id, container_id)
+        if container.status == "paused" and job.next_run_time:
+            job.pause()
+        elif container.status != "paused" and not job.next_run_time:
+            job.resume()
+        result.add(container_id)
+
+    return result
 
 
 def reassign_jobs(container_id: str, consider_paused: bool) -> Optional[str]:
@@ -132,7 +318,7 @@ def reassign_jobs(container_id: str, consider_paused: bool) -> Optional[str]:
     log.info(f"{container_name(container_id)}: Reassigning jobs to {new_id}.")
 
     for job in jobs.get_jobs_for_container(container_id):
-        log.debug(f"Handling job: {job.kwargs}")
+        log.debug("Handling job: %s", job.kwargs)
         job_is_paused = not bool(job.next_run_time)
 
         if container_is_paused and not job_is_paused:
@@ -145,6 +331,7 @@ def reassign_jobs(container_id: str, consider_paused: bool) -> Optional[str]:
         # job.modify(kwargs={**job.kwargs, "container_id": new_id})
         job.modify(kwargs=(job.kwargs | {"container_id": new_id}))
 
+    reassign_job_ids(container_id, new_id)
     reassign_service_lock(container_id, new_id)
 
     return new_id
@@ -183,44 +370,290 @@ def find_other_container_for_service(
 ####
 
 
-def listen(since: datetime):
-    log.info("Listening to events.")
-    for event_json in cfg.client.events(since=since):
-        if b'container' not in event_json:
+def subscribe_to_events() -> Queue:
+    """Subscribes to the daemon's events and buffers the relevant ones in the
+    returned queue from a separate thread, hence events that occur while running
+    containers are inspected are not missed."""
+    events: Queue = Queue(maxsize=EVENTS_QUEUE_SIZE)
+    # the subscription is established with this call
+    stream = cfg.client.events(filters=EVENTS_FILTERS)
+    Thread(
+        target=read_events, args=(stream, events), name="event-reader", daemon=True
+    ).start()
+    return events
+
+
+def read_events(stream: Iterable[bytes], events: Queue):
+    """Puts the events from the stream into the queue. When the stream ends or fails,
+    the subscription is renewed, so that the daemon repeats the events since the
+    last received one. A daemon that was unreachable meanwhile has likely been
+    restarted and lost the missed events, then a reconciliation is queued. When all
+    reconnection attempts failed, the last error or ``None`` is queued."""
+    subscription = EventsSubscription()
+
+    while True:
+        try:
+            for event_json in stream:
+                if (event := subscription.accept(event_json)) is not None:
+                    events.put(event)
+        except Exception as e:
+            subscription.interrupted(e)
+        else:
+            subscription.interrupted(None)
+
+        resubscribed = resubscribe(subscription, events)
+        if resubscribed is None:
+            events.put(subscription.error)
+            return
+        stream = resubscribed
+
+
+def resubscribe(
+    subscription: "EventsSubscription", events: Queue
+) -> Optional[Iterable[bytes]]:
+    """Returns a renewed stream of events or ``None`` when all attempts failed. A
+    reconciliation is queued if the daemon was unreachable."""
+    for delay in subscription.delays:
+        sleep(delay)
+        try:
+            stream = cfg.client.events(filters=EVENTS_FILTERS, since=subscription.since)
+        except Exception as e:
+            subscription.reconnection_failed(e)
             continue
 
-        if not any((x in event_json) for x in (b'start', b'die', b'pause', b'unpause')):
-            continue
+        if subscription.reconnected():
+            try:
+                events.put(take_snapshot())
+            except Exception as e:
+                log.error(f"Failed to list the running containers: {e}")
+        return stream
+
+    return None
 
+
+class EventsSubscription:
+    """Keeps the state of a subscription to the daemon's events across reconnections,
+    the reading and reconnecting is left to the runtime's implementation."""
+
+    def __init__(self):
+        self.delays = reconnection_delays()
+        self.error: Optional[Exception] = None
+        self.last_event_time: Optional[int] = None
+        self.unreachable = False
+
+    @property
+    def since(self) -> Optional[str]:
+        return format_event_time(self.last_event_time)
+
+    def accept(self, event_json: bytes) -> Optional[dict]:
+        """Returns the parsed event unless the daemon repeated it."""
         event = json.loads(event_json)
-        log.debug(f'Daemon event: {event}')
-        if event['Type'] != 'container':
+        if is_repeated_event(event, self.last_event_time):
+            return None
+        event_statistics["received"] += 1
+        metrics.increment("deck_chores_events_received_total", action=event["Action"])
+        self.last_event_time = event.get("timeNano", self.last_event_time)
+        # a successful reconnection resets the backoff
+        self.delays = reconnection_delays()
+        return event
+
+    def interrupted(self, error: Optional[Exception]):
+        self.error = error
+        if error is None:
+            log.warning("The daemon ended the stream of events.")
+        else:
+            log.warning(f"Reading the daemon's events failed: {error}")
+        self.unreachable = self.last_event_time is None
+
+    def reconnection_failed(self, error: Exception):
+        self.error = error
+        self.unreachable = True
+        log.warning(f"Reconnecting to the daemon's events failed: {error}")
+
+    def reconnected(self) -> bool:
+        """Returns whether the containers' states must be reconciled."""
+        event_statistics["reconnections"] += 1
+        log.info("Reconnected to the daemon's events.")
+        return self.unreachable
+
+
+def reconnection_delays() -> Iterator[float]:
+    """Yields the delays in seconds before the attempts to reconnect to the daemon's
+    events, the first attempt is immediate, the further ones back off exponentially."""
+    for attempt in range(cfg.events_reconnect_attempts):
+        yield min(RECONNECT_BASE_DELAY * 2 ** (attempt - 1), 30) if attempt else 0
+
+
+def is_repeated_event(event: dict, last_event_time: Optional[int]) -> bool:
+    # the daemon includes events that occurred at the time of the since parameter
+    return last_event_time is not None and (
+        event.get("timeNano", last_event_time + 1) <= last_event_time
+    )
+
+
+def format_event_time(time: Optional[int]) -> Optional[str]:
+    if time is None:
+        return None
+    seconds, nanoseconds = divmod(time, 10**9)
+    return f"{seconds}.{nanoseconds:09}"
+
+
+def listen(events: Queue):
+    log.info("Listening to events.")
+    while True:
+        batch = take_events(events)
+        event_statistics["max_batch_size"] = max(
+            event_statistics["max_batch_size"], len(batch)
+        )
+
+        for event in coalesce_events(batch):
+            if event is None:
+                return
+            if isinstance(event, Exception):
+                raise event
+            dispatch_event(event)
+
+
+def dispatch_event(event: dict):
+    log.debug('Daemon event: %s', event)
+    started_at = perf_counter()
+
+    # the times are only recorded while periodic reconciliations prune them, the
+    # reconciliations after reconnections go without the margin otherwise
+    if (
+        cfg.reconciliation_interval
+        and event["Type"] == "container"
+        and "timeNano" in event
+    ):
+        _event_times[event["Actor"]["ID"]] = event["timeNano"]
+
+    match event["Type"], event["Action"]:
+        case "container", "start":
+            handle_start(event)
+        case "container", "restart":
+            handle_restart(event)
+        case "container", "die":
+            handle_die(event)
+        case "container", "pause":
+            handle_pause(event)
+        case "container", "unpause":
+            handle_unpause(event)
+        case "image", "delete":
+            handle_image_delete(event)
+        case "deck-chores", "reconcile":
+            handle_reconcile(event)
+
+    event_statistics["handled"] += 1
+    metrics.observe(
+        "deck_chores_event_handling_seconds",
+        perf_counter() - started_at,
+        type=event["Type"],
+        action=event["Action"],
+    )
+
+
+def take_events(events: Queue) -> list:
+    """Takes the events that queued up while the previous ones were handled at once,
+    so that superseded ones can be dropped. If these include a container's death,
+    more events are awaited for the configured debounce time, so that a restart is
+    likely to be contained in one batch."""
+    batch = [events.get()]
+    deadline = None
+
+    while batch[-1] is not None and not isinstance(batch[-1], Exception):
+        if deadline is None and cfg.events_debounce and batch[-1]["Action"] == "die":
+            deadline = perf_counter() + cfg.events_debounce
+        try:
+            if deadline is None:
+                batch.append(events.get_nowait())
+            else:
+                batch.append(events.get(timeout=max(0, deadline - perf_counter())))
+        except Empty:
+            break
+
+    return batch
+
+
+def coalesce_events(events: list) -> list:
+    """Drops the events of containers that were started and died within the given
+    sequence except the death, as handling these would add jobs that are
+    immediately removed. The death is kept as the container may have been
+    recorded from the startup listing already.
+    A container's death that is followed by its start is replaced by a restart
+    event, as its labels and thus its jobs are unchanged. The order of the remaining
+    events is kept."""
+    superseded: set[int] = set()
+    replaced: dict[int, dict] = {}
+    started: dict[str, list[int]] = {}
+    died: dict[str, int] = {}
+
+    for index, event in enumerate(events):
+        if not isinstance(event, dict) or event["Type"] != "container":
             continue
 
+        container_id = event["Actor"]["ID"]
         match event["Action"]:
             case "start":
-                handle_start(event)
+                if (die_index := died.pop(container_id, None)) is not None:
+                    superseded.add(die_index)
+                    replaced[index] = event | {"Action": "restart"}
+                started[container_id] = [index]
+            case "die" if container_id in started:
+                for start_index in started.pop(container_id):
+                    superseded.add(start_index)
+                    replaced.pop(start_index, None)
+                died[container_id] = index
             case "die":
-                handle_die(event)
-            case "pause":
-                handle_pause(event)
-            case "unpause":
-                handle_unpause(event)
+                died[container_id] = index
+            case _ if container_id in started:
+                started[container_id].append(index)
+
+    if not (superseded or replaced):
+        return events
+
+    log.debug(
+        "Dropping %i superseded events, coalesced %i restarts.",
+        len(superseded),
+        len(replaced),
+    )
+    event_statistics["coalesced"] += len(superseded)
+    return [replaced.get(i, e) for i, e in enumerate(events) if i not in superseded]
 
 
 def handle_start(event: dict):
     container_id = event['Actor']['ID']
-    log.debug(f'Handling start of {container_id}.')
+    log.debug('Handling start of %s.', container_id)
+    set_container_state(container_id, "running")
     process_started_container_labels(container_id, paused=False)
 
 
+def handle_restart(event: dict):
+    container_id = event['Actor']['ID']
+    log.debug('Handling restart of %s.', container_id)
+    set_container_state(container_id, "running")
+    if container_id not in job_ids_by_container_id:
+        # the container's death didn't affect any job
+        process_started_container_labels(container_id, paused=False)
+        return
+
+    counter = 0
+    for job in jobs.get_jobs_for_container(container_id):
+        if not job.next_run_time:
+            job.resume()
+            counter += 1
+    log.info(f"{container_name(container_id)}: Kept jobs across a restart.")
+    if counter:
+        log.info(f"{container_name(container_id)}: Resumed {counter} jobs.")
+
+
 def handle_die(event: dict):
     container_id = event['Actor']['ID']
-    log.debug(f'Handling die of {container_id}.')
+    log.debug('Handling die of %s.', container_id)
+    discard_container_state(container_id)
     if reassign_jobs(container_id, consider_paused=True) is None:
         for job in jobs.get_jobs_for_container(container_id):
             definition = job.kwargs
-            log.debug(f"Removing job: {definition}")
+            log.debug("Removing job: %s", definition)
             job.remove()
             log.info(
                 f"{container_name(container_id)}: Removed '"
@@ -232,7 +665,8 @@ def handle_die(event: dict):
 
 def handle_pause(event: dict):
     container_id = event['Actor']['ID']
-    log.debug(f'Handling pause of {container_id}.')
+    log.debug('Handling pause of %s.', container_id)
+    set_container_state(container_id, "paused")
 
     if reassign_jobs(container_id, consider_paused=False) is None:
         counter = 0
@@ -240,14 +674,15 @@ def handle_pause(event: dict):
             jobs.get_jobs_for_container(container_id), start=1
         ):
             job.pause()
-            log.debug(f"Paused job: {job.kwargs}")
+            log.debug("Paused job: %s", job.kwargs)
         if counter:
             log.info(f"{container_name(container_id)}: Paused {counter} jobs.")
 
 
 def handle_unpause(event: dict):
     container_id = event['Actor']['ID']
-    log.debug(f'Handling unpause of {container_id}.')
+    log.debug('Handling unpause of %s.', container_id)
+    set_container_state(container_id, "running")
 
     if container_id not in service_locks_by_container_id:
         service_id, _, _ = parse_labels(container_id)
@@ -262,16 +697,135 @@ def handle_unpause(event: dict):
     counter = 0
     for counter, job in enumerate(jobs.get_jobs_for_container(container_id), start=1):
         job.resume()
-        log.debug(f"Resumed job: {job.kwargs}")
+        log.debug("Resumed job: %s", job.kwargs)
     if counter:
         log.info(f"{container_name(container_id)}: Resumed {counter} jobs.")
 
 
+def handle_image_delete(event: dict):
+    log.debug("Handling deletion of image %s.", event['Actor']['ID'])
+    image_definition_labels.cache_clear()
+
+
+####
+
+
+def start_reconciliation(events: Queue):
+    if cfg.reconciliation_interval:
+        Thread(
+            target=reconcile_periodically,
+            args=(events,),
+            name="reconciler",
+            daemon=True,
+        ).start()
+
+
+def reconcile_periodically(events: Queue):
+    """Puts a listing of the running containers into the events' queue in the
+    configured interval, so that it's compared to the recorded states by the thread
+    that handles the events."""
+    while True:
+        sleep(cfg.reconciliation_interval)
+        try:
+            events.put(take_snapshot())
+        except Exception as e:
+            log.error(f"Failed to list the running containers: {e}")
+
+
+def take_snapshot() -> dict:
+    started_at, listing_started_at = time_ns(), perf_counter()
+    containers = cfg.client.containers.list(ignore_removed=True, sparse=True)
+    return reconciliation_event(
+        containers, started_at, perf_counter() - listing_started_at
+    )
+
+
+def reconciliation_event(
+    containers: list[Container], started_at: int, listing_time: float
+) -> dict:
+    return {
+        "Type": "deck-chores",
+        "Action": "reconcile",
+        "Containers": containers,
+        "ListingTime": listing_time,
+        "timeNano": started_at,
+    }
+
+
+def handle_reconcile(event: dict):
+    """Compares the listed containers' states with the recorded ones and handles
+    deviations as if the according events had been received. At most
+    ``RECONCILIATION_LIMIT`` deviations are corrected, the remaining ones are left to
+    the next reconciliation."""
+    started_at = perf_counter()
+    cutoff = event["timeNano"] - RECONCILIATION_TIME_MARGIN
+    listed = {c.id: c for c in event["Containers"]}
+    # containers in transitional states are reconsidered by the next reconciliation
+    observed_states = {
+        c.id: c.status for c in listed.values() if c.status in ("paused", "running")
+    }
+    transitional = listed.keys() - observed_states.keys()
+
+    deviations = sorted(
+        container_id
+        for container_id in (observed_states.keys() | container_states.keys())
+        - transitional
+        if container_states.get(container_id) != observed_states.get(container_id)
+        and _event_times.get(container_id, cutoff - 1) < cutoff
+    )
+    corrections = deviations[:RECONCILIATION_LIMIT]
+
+    # the listing's attributes include the names and labels of started containers
+    prefetch_attributes(listed[i] for i in corrections if i in listed)
+    try:
+        for container_id in corrections:
+            correct_container_state(
+                container_id,
+                container_states.get(container_id),
+                observed_states.get(container_id),
+            )
+    finally:
+        discard_prefetched_attributes()
+
+    for container_id, event_time in tuple(_event_times.items()):
+        if event_time < cutoff:
+            del _event_times[container_id]
+
+    event_statistics["reconciliations"] += 1
+    event_statistics["reconciled"] += len(corrections)
+    (log.info if deviations else log.debug)(
+        f"Reconciled the states of {len(listed)} containers with "
+        f"{len(corrections)} corrections, {len(deviations) - len(corrections)} "
+        f"deferred, in {event['ListingTime'] + perf_counter() - started_at:.3f} "
+        "seconds."
+    )
+
+
+def correct_container_state(
+    container_id: str, recorded: Optional[str], observed: Optional[str]
+):
+    log.info(
+        f"Container {container_id} is {observed or 'gone'}, recorded was "
+        f"{recorded or 'none'}."
+    )
+    event = {"Actor": {"ID": container_id}}
+    if observed is None:
+        handle_die(event)
+    elif recorded is None:
+        set_container_state(container_id, observed)
+        process_started_container_labels(container_id, paused=observed == "paused")
+    elif observed == "paused":
+        handle_pause(event)
+    else:
+        handle_unpause(event)
+
+
 def shutdown():  # pragma: nocover
     try:
         jobs.scheduler.shutdown()
     except SchedulerNotRunningError:
         pass
+    join_output_handling()
 
     if hasattr(cfg, "client"):
         cfg.client.close()
@@ -304,7 +858,7 @@ def main():  # pragma: nocover
     try:
         generate_config()
         configure_logging(cfg)
-        log.debug(f'Config: {cfg.__dict__}')
+        log.debug('Config: %s', cfg.__dict__)
 
         if there_is_another_deck_chores_container():
             log.error(
@@ -314,10 +868,22 @@ def main():  # pragma: nocover
             raise SystemExit(1)
 
         job_config_validator.set_defaults(cfg)
-
-        last_event_time = inspect_running_containers()
-        jobs.start_scheduler()
-        listen(since=last_event_time + timedelta(microseconds=1))
+        serve_metrics()
+
+        if cfg.runtime == "asyncio":
+            # the module imports this one
+            from deck_chores import aio
+
+            asyncio.run(aio.run())
+        else:
+            events = subscribe_to_events()
+            # stored jobs are restored from a paused scheduler, when it's resumed
+            # missed runs are handled
+            jobs.start_scheduler(paused=True)
+            inspect_running_containers()
+            jobs.scheduler.resume()
+            start_reconciliation(events)
+            listen(events)
 
     except SystemExit as e:
         exit_code = e.code
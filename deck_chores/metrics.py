@@ -0,0 +1,262 @@
+from bisect import bisect_left
+from collections import deque
+from collections.abc import Callable, Iterable, Mapping
+from math import ceil
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from typing import Final, Optional
+
+from deck_chores.utils import log
+
+
+####
+
+
+# the upper bounds of the histograms' buckets in seconds
+BUCKETS: Final = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300, 3600)
+
+METRICS: Final[dict[str, tuple[str, str]]] = {
+    "deck_chores_events_received_total": (
+        "counter",
+        "Events that were received from the Docker daemon.",
+    ),
+    "deck_chores_event_handling_seconds": (
+        "histogram",
+        "The time that handling an event took.",
+    ),
+    "deck_chores_job_executions_total": (
+        "counter",
+        "Executions of jobs' commands that finished.",
+    ),
+    "deck_chores_job_errors_total": (
+        "counter",
+        "Executions of jobs that failed in deck-chores.",
+    ),
+    "deck_chores_execution_seconds": (
+        "histogram",
+        "The time that jobs' commands ran.",
+    ),
+    "deck_chores_scheduler_lag_seconds": (
+        "histogram",
+        "The delay of jobs' submissions to an executor after their scheduled time.",
+    ),
+    "deck_chores_job_runs_missed_total": (
+        "counter",
+        "Runs of jobs that were missed by more than the misfire grace time.",
+    ),
+    "deck_chores_job_runs_skipped_total": (
+        "counter",
+        "Runs of jobs that were skipped as their maximum instances were running.",
+    ),
+    "deck_chores_jobs_running": (
+        "gauge",
+        "Jobs that occupy an executor.",
+    ),
+    "deck_chores_jobs_queued": (
+        "gauge",
+        "Executions of jobs that await their admission by the concurrency limits.",
+    ),
+    "deck_chores_queue_wait_seconds": (
+        "histogram",
+        "The time that executions of jobs awaited their admission.",
+    ),
+}
+
+Labels = tuple[tuple[str, str], ...]
+Collector = Callable[[], Iterable[tuple[Mapping[str, str], float]]]
+
+_lock: Final = Lock()
+_values: Final[dict[tuple[str, Labels], float]] = {}
+# per labels the counts of observations in each bucket and above all, their sum
+# and their count
+_histograms: Final[dict[tuple[str, Labels], list[float]]] = {}
+_collectors: Final[dict[str, tuple[str, str, Collector]]] = {}
+
+
+def increment(name: str, amount: float = 1, **labels: str):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _values[key] = _values.get(key, 0) + amount
+
+
+def observe(name: str, value: float, **labels: str):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        if (histogram := _histograms.get(key)) is None:
+            histogram = _histograms[key] = [0] * (len(BUCKETS) + 3)
+        histogram[bisect_left(BUCKETS, value)] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+
+def register_collector(name: str, metric_type: str, help: str, collect: Collector):
+    """Registers a function that provides the samples of a metric when the metrics
+    are rendered."""
+    _collectors[name] = (metric_type, help, collect)
+
+
+####
+
+
+# the number of the most recent timings that are considered for the percentiles,
+# overall and per job
+TIMINGS_SIZE: Final = 1024
+JOB_TIMINGS_SIZE: Final = 128
+PERCENTILES: Final = (50, 90, 99)
+# the timings' kinds are:
+# start_delay - from a job's scheduled time to the start of its execution
+# run_time - from the start of an execution to its end
+# missed_by - the lateness of a missed run
+# queue_wait - from a run's submission to its admission by the concurrency limits
+TIMING_KINDS: Final = ("start_delay", "run_time", "missed_by", "queue_wait")
+
+_timings: Final[dict[str, deque[float]]] = {
+    kind: deque(maxlen=TIMINGS_SIZE) for kind in TIMING_KINDS
+}
+_job_timings: Final[dict[str, dict[str, deque[float]]]] = {}
+
+
+def record_timing(kind: str, job_id: str, seconds: float):
+    with _lock:
+        _timings[kind].append(seconds)
+        job_timings = _job_timings.get(job_id)
+        if job_timings is None:
+            job_timings = _job_timings[job_id] = {
+                k: deque(maxlen=JOB_TIMINGS_SIZE) for k in TIMING_KINDS
+            }
+        job_timings[kind].append(seconds)
+
+
+def discard_job_timings(job_id: Optional[str] = None):
+    """Discards the timings of the job or of all jobs if none is given."""
+    with _lock:
+        if job_id is None:
+            _job_timings.clear()
+        else:
+            _job_timings.pop(job_id, None)
+
+
+def timings_report() -> dict:
+    """Returns the percentiles of the recorded timings overall and per job."""
+    with _lock:
+        return {
+            kind: {
+                "all": summarize(_timings[kind]),
+                "jobs": {
+                    job_id: summarize(timings[kind])
+                    for job_id, timings in _job_timings.items()
+                    if timings[kind]
+                },
+            }
+            for kind in TIMING_KINDS
+        }
+
+
+def summarize(samples: Iterable[float]) -> dict[str, float]:
+    ordered = sorted(samples)
+    if not ordered:
+        return {"count": 0}
+    result: dict[str, float] = {"count": len(ordered)}
+    for percentile in PERCENTILES:
+        # the nearest rank
+        result[f"p{percentile}"] = round(
+            ordered[ceil(percentile / 100 * len(ordered)) - 1], 6
+        )
+    result["max"] = round(ordered[-1], 6)
+    return result
+
+
+####
+
+
+def render() -> str:
+    """Renders all metrics in Prometheus' text-based exposition format."""
+    samples: dict[str, list[str]] = {}
+    with _lock:
+        for (name, labels), value in _values.items():
+            samples.setdefault(name, []).append(
+                f"{name}{format_labels(labels)} {value:g}"
+            )
+        for (name, labels), histogram in _histograms.items():
+            lines = samples.setdefault(name, [])
+            cumulated = 0.0
+            for bound, count in zip((*BUCKETS, "+Inf"), histogram):
+                cumulated += count
+                lines.append(
+                    f"{name}_bucket{format_labels(labels + (('le', str(bound)),))} "
+                    f"{cumulated:g}"
+                )
+            lines.append(f"{name}_sum{format_labels(labels)} {histogram[-2]:g}")
+            lines.append(f"{name}_count{format_labels(labels)} {histogram[-1]:g}")
+
+    types = dict(METRICS)
+    for name, (metric_type, help, collect) in _collectors.items():
+        types[name] = (metric_type, help)
+        samples[name] = [
+            f"{name}{format_labels(tuple(sorted(labels.items())))} {value:g}"
+            for labels, value in collect()
+        ]
+
+    result = []
+    for name, lines in samples.items():
+        metric_type, help = types[name]
+        result.append(f"# HELP {name} {help}")
+        result.append(f"# TYPE {name} {metric_type}")
+        result.extend(lines)
+    return "\n".join(result) + "\n"
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return (
+        "{"
+        + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in labels)
+        + "}"
+    )
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+####
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+
+        content = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        log.debug("Metrics request from %s: %s", self.address_string(), format % args)
+
+
+def serve(port: int) -> ThreadingHTTPServer:
+    """Serves the metrics at the path ``/metrics`` on the given port from a
+    separate thread."""
+    server = ThreadingHTTPServer(("", port), MetricsRequestHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    log.info(f"Serving metrics on port {server.server_address[1]}.")
+    return server
+
+
+__all__ = (
+    discard_job_timings.__name__,
+    increment.__name__,
+    observe.__name__,
+    record_timing.__name__,
+    register_collector.__name__,
+    render.__name__,
+    serve.__name__,
+    timings_report.__name__,
+)
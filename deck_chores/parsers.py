@@ -1,17 +1,24 @@
+import re
 from collections import defaultdict
 from collections.abc import Mapping
 from functools import lru_cache
-from typing import Final, Optional, Type
+from hashlib import sha256
+from threading import Lock
+from types import MappingProxyType
+from typing import Any, Callable, Final, Optional, Type
 
 import cerberus
+from apscheduler.triggers.base import BaseTrigger
 from apscheduler.triggers.cron import CronTrigger
 from apscheduler.triggers.date import DateTrigger
 from apscheduler.triggers.interval import IntervalTrigger
 from pytz import all_timezones
 
 from deck_chores.config import cfg, CONTAINER_CACHE_SIZE
+from deck_chores.indexes import prefetched_attributes
 from deck_chores.utils import (
     log,
+    parse_size,
     parse_time_from_string_with_units,
     seconds_as_interval_tuple,
     split_string,
@@ -42,59 +49,261 @@ class JobConfigValidator(cerberus.Validator):
         schema["name"]["regex"] = cfg.job_name_regex
         schema["timezone"]["default"] = cfg.timezone
         schema.validate()
-
-    @staticmethod
-    @lru_cache(128)
-    def _fill_args(value: str, length: int, filling: str) -> tuple[str, ...]:
-        value = value.strip()
-        while '  ' in value:
-            value = value.replace('  ', ' ')
-        tokens = value.split(' ')
-        return tuple([filling] * (length - len(tokens)) + tokens)
+        # previously validated definitions may have been normalized differently
+        validate_job_definition.cache_clear()
 
     def _normalize_coerce_cron(self, value: str) -> tuple[Type, tuple[str, ...]]:
-        args = self._fill_args(value, CRON_TRIGGER_FIELDS_COUNT, '*')
-        return CronTrigger, args
+        return coerce_cron(value)
 
     def _normalize_coerce_date(self, value: str) -> tuple[Type, tuple[str]]:
-        return DateTrigger, (value,)
+        return coerce_date(value)
 
     def _normalize_coerce_interval(
         self, value: str
     ) -> tuple[Type, Optional[tuple[int, int, int, int, int]]]:
-        args = NAME_INTERVAL_MAP.get(value)
-        if args is None:
-            if any(x.isalpha() for x in value):
-                parsed_value = parse_time_from_string_with_units(value)
-                if parsed_value:
-                    args = seconds_as_interval_tuple(parsed_value)
-            else:
-                value = value.translate(INTERVAL_SEPARATOR_TRANSLATION_TABLE)
-                filled_args = self._fill_args(value, 5, '0')
-                args = tuple(int(x) for x in filled_args)  # type: ignore
-        return IntervalTrigger, args
+        return coerce_interval(value)
+
+    def _normalize_coerce_size(self, value: str) -> int:
+        return parse_size(value)
 
     def _normalize_coerce_timeunits(self, value: str) -> Optional[int]:
-        if any(x.isalpha() for x in value):
-            return parse_time_from_string_with_units(value)
-        return int(value)
+        return coerce_timeunits(value)
 
     def _check_with_trigger(self, field, value):
         if isinstance(value, str):  # normalization failed
             return
 
-        trigger_class, args = value[0], value[1]
-        try:
-            trigger_class(*args, timezone=self.document.get('timezone', cfg.timezone))
-        except Exception as e:
-            message = (
-                f"Error while instantiating a {trigger_class.__name__} with '{args}'."
-            )
-            if cfg.debug:
-                message += f"\n{e}"
+        message = check_trigger(
+            value,
+            self.document.get('timezone', cfg.timezone),
+            self.document.get('jitter'),
+        )
+        if message is not None:
             self._error(field, message)
 
 
+class CompiledJobConfigValidator:
+    """A validator with the same results as the job_config_validator, implemented
+    for its schema and the documents that parse_job_definitions produces, whose
+    values are strings except for a mapping of environment variables."""
+
+    def __init__(self, reference: JobConfigValidator):
+        # the defaults and the name pattern are read from the reference's schema
+        self.reference = reference
+        self.errors: dict[str, list[str]] = {}
+
+    def validated(self, document: Mapping) -> Optional[dict]:
+        schema = self.reference.schema
+        errors: dict[str, list[str]] = {}
+        result = dict(document)
+
+        for field in ('environment', 'max', 'timezone'):
+            if result.get(field) is None:
+                result[field] = (
+                    {} if field == 'environment' else schema[field]['default']
+                )
+
+        for field, value in result.items():
+            coerce = COERCIONS.get(field)
+            if coerce is None:
+                continue
+            try:
+                result[field] = coerce(value)
+            except Exception as e:
+                errors.setdefault(field, []).append(
+                    f"field '{field}' cannot be coerced: {e}"
+                )
+
+        unrequired_by_excludes: set[str] = set()
+        for field, value in result.items():
+            field_errors: list[str] = []
+            match field:
+                case 'cron' | 'date' | 'interval':
+                    if not isinstance(value, str):  # normalization failed otherwise
+                        message = check_trigger(
+                            value, result['timezone'], result.get('jitter')
+                        )
+                        if message is not None:
+                            field_errors.append(message)
+                    excluded_fields = EXCLUSIONS[field]
+                    unrequired_by_excludes.add(field)
+                    unrequired_by_excludes.update(excluded_fields)
+                    if any(x in result for x in excluded_fields):
+                        field_errors.append(
+                            ', '.join(f"'{x}'" for x in excluded_fields)
+                            + f" must not be present with '{field}'"
+                        )
+                case 'environment':
+                    if not isinstance(value, Mapping):
+                        field_errors.append('must be of dict type')
+                case 'jitter':
+                    if value is None:
+                        pass
+                    elif not isinstance(value, int):
+                        field_errors.append('must be of integer type')
+                    elif value < 0:
+                        field_errors.append('min value is 0')
+                case 'output_limit':
+                    if not isinstance(value, int):
+                        field_errors.append('must be of integer type')
+                    elif value < 0:
+                        field_errors.append('min value is 0')
+                case 'name':
+                    pattern = schema['name']['regex']
+                    if not matches_regex(pattern, value):
+                        field_errors.append(f"value does not match regex '{pattern}'")
+                case 'user':
+                    # empty values aren't matched
+                    if value and not matches_regex(USER_PATTERN, value):
+                        field_errors.append(
+                            f"value does not match regex '{USER_PATTERN}'"
+                        )
+                case 'workdir':
+                    if not matches_regex(WORKDIR_PATTERN, value):
+                        field_errors.append(
+                            f"value does not match regex '{WORKDIR_PATTERN}'"
+                        )
+                case 'priority':
+                    if value not in PRIORITIES:
+                        field_errors.append(f'unallowed value {value}')
+                case 'timezone':
+                    if value not in ALL_TIMEZONES:
+                        field_errors.append(f'unallowed value {value}')
+                case 'command' | 'max':
+                    pass
+                case _:
+                    field_errors.append('unknown field')
+
+            if field_errors:
+                errors.setdefault(field, []).extend(field_errors)
+
+        required = REQUIRED_FIELDS - unrequired_by_excludes
+        for field in sorted(required - set(result)):
+            errors.setdefault(field, []).append('required field')
+
+        self.errors = errors
+        return None if errors else result
+
+
+####
+
+
+ALL_TIMEZONES: Final = frozenset(all_timezones)
+# the classes in descending order
+PRIORITIES: Final = ('high', 'normal', 'low')
+USER_PATTERN: Final = r'[a-zA-Z0-9_.][a-zA-Z0-9_.-]*'
+WORKDIR_PATTERN: Final = r'/.*'
+EXCLUSIONS: Final = {
+    'cron': ('date', 'interval'),
+    'date': ('cron', 'interval', 'jitter'),
+    'interval': ('cron', 'date'),
+}
+REQUIRED_FIELDS: Final = frozenset(
+    ('command', 'cron', 'date', 'interval', 'name', 'user')
+)
+
+
+@lru_cache(128)
+def fill_args(value: str, length: int, filling: str) -> tuple[str, ...]:
+    value = value.strip()
+    while '  ' in value:
+        value = value.replace('  ', ' ')
+    tokens = value.split(' ')
+    return tuple([filling] * (length - len(tokens)) + tokens)
+
+
+def coerce_cron(value: str) -> tuple[Type, tuple[str, ...]]:
+    args = fill_args(value, CRON_TRIGGER_FIELDS_COUNT, '*')
+    return CronTrigger, args
+
+
+def coerce_date(value: str) -> tuple[Type, tuple[str]]:
+    return DateTrigger, (value,)
+
+
+def coerce_interval(
+    value: str,
+) -> tuple[Type, Optional[tuple[int, int, int, int, int]]]:
+    args = NAME_INTERVAL_MAP.get(value)
+    if args is None:
+        if any(x.isalpha() for x in value):
+            parsed_value = parse_time_from_string_with_units(value)
+            if parsed_value:
+                args = seconds_as_interval_tuple(parsed_value)
+        else:
+            value = value.translate(INTERVAL_SEPARATOR_TRANSLATION_TABLE)
+            filled_args = fill_args(value, 5, '0')
+            args = tuple(int(x) for x in filled_args)  # type: ignore
+    return IntervalTrigger, args
+
+
+def coerce_timeunits(value: str) -> Optional[int]:
+    if any(x.isalpha() for x in value):
+        return parse_time_from_string_with_units(value)
+    return int(value)
+
+
+COERCIONS: Final[dict[str, Callable[[str], Any]]] = {
+    'cron': coerce_cron,
+    'date': coerce_date,
+    'interval': coerce_interval,
+    'jitter': coerce_timeunits,
+    'max': int,
+    'output_limit': parse_size,
+}
+
+
+def check_trigger(
+    value: tuple[Type, tuple], timezone: str, jitter: Optional[int] = None
+) -> Optional[str]:
+    trigger_class, args = value[0], value[1]
+    if not isinstance(jitter, int):  # it's validated separately
+        jitter = None
+    try:
+        create_trigger(trigger_class, args, timezone, jitter)
+    except Exception as e:
+        message = f"Error while instantiating a {trigger_class.__name__} with '{args}'."
+        if cfg.debug:
+            message += f"\n{e}"
+        return message
+    return None
+
+
+# a trigger's state is immutable after its instantiation, hence one instance is
+# shared by all validated definitions and jobs with the same specification
+@lru_cache(maxsize=CONTAINER_CACHE_SIZE)
+def cached_trigger(
+    trigger_class: type,
+    args: tuple,
+    timezone: str,
+    jitter: Optional[int] = None,
+) -> BaseTrigger:
+    if jitter is None:
+        return trigger_class(*args, timezone=timezone)
+    return trigger_class(*args, timezone=timezone, jitter=jitter)
+
+
+def create_trigger(
+    trigger_class: type,
+    args: tuple,
+    timezone: str,
+    jitter: Optional[int] = None,
+) -> BaseTrigger:
+    if trigger_class is IntervalTrigger:
+        # an interval starts when its trigger is instantiated
+        return cached_trigger.__wrapped__(trigger_class, args, timezone, jitter)
+    return cached_trigger(trigger_class, args, timezone, jitter)
+
+
+def matches_regex(pattern: str, value: str) -> bool:
+    if not isinstance(value, str):
+        return True
+    # that is how Cerberus matches patterns
+    if not pattern.endswith('$'):
+        pattern += '$'
+    return re.match(pattern, value) is not None
+
+
 job_config_validator = JobConfigValidator(
     {
         'command': {'required': True},
@@ -125,49 +334,116 @@ job_config_validator = JobConfigValidator(
         },
         'max': {'coerce': int},  # default is set later
         'name': {"required": True},  # regex is set later
-        'timezone': {'allowed': all_timezones},  # default is set later
+        'output_limit': {'type': 'integer', 'coerce': 'size', 'min': 0},
+        'priority': {'allowed': PRIORITIES},
+        'timezone': {'allowed': ALL_TIMEZONES},  # default is set later
         'user': {
             "empty": True,
-            'regex': r'[a-zA-Z0-9_.][a-zA-Z0-9_.-]*',
+            'regex': USER_PATTERN,
             "required": True,
         },
-        'workdir': {'regex': r'/.*'},
+        'workdir': {'regex': WORKDIR_PATTERN},
     }
 )
+compiled_job_config_validator = CompiledJobConfigValidator(job_config_validator)
+
+
+# the validator keeps state while processing a document
+validation_lock: Final = Lock()
 
 
 ####
 
 
+ParsedLabels = tuple[tuple[str, ...], str, dict[str, dict]]
+
+
 @lru_cache(maxsize=CONTAINER_CACHE_SIZE)
-def parse_labels(container_id: str) -> tuple[tuple[str, ...], str, dict[str, dict]]:
-    labels = cfg.client.containers.get(container_id).labels
-    log.debug(f'Parsing labels: {labels}')
+def parse_labels(container_id: str) -> ParsedLabels:
+    attributes = prefetched_attributes.get(container_id)
+    if attributes is None:
+        container = cfg.client.containers.get(container_id)
+        labels, image_id = container.labels, container.attrs['Image']
+    else:
+        labels, image_id = attributes['Labels'] or {}, attributes['ImageID']
+    log.debug('Parsing labels: %s', labels)
 
     service_id = parse_service_id(labels)
 
     filtered_labels = {k: v for k, v in labels.items() if k.startswith(cfg.label_ns)}
-    flags, user = parse_options(filtered_labels)
+    flags, user, concurrency = parse_options(filtered_labels)
 
     if 'image' in flags:
-        image_labels = image_definition_labels_of_container(container_id)
-        user = user or parse_options(image_labels)[1]
+        image_labels = dict(image_definition_labels(image_id))
+        _, image_user, image_concurrency = parse_options(image_labels)
+        user = user or image_user
+        concurrency = concurrency or image_concurrency
     else:
         image_labels = {}
 
     job_definitions = parse_job_definitions(image_labels | filtered_labels, user)
 
     if service_id:
-        log.debug(f'Assigning service id: {service_id}')
+        log.debug('Assigning service id: %s', service_id)
         for job_definition in job_definitions.values():
             job_definition['service_id'] = service_id
+    if concurrency:
+        for job_definition in job_definitions.values():
+            job_definition['concurrency'] = concurrency
+    fingerprint = labels_fingerprint(labels, image_id)
+    for job_definition in job_definitions.values():
+        job_definition['fingerprint'] = fingerprint
     return service_id, flags, job_definitions
 
 
-def parse_options(labels: dict[str, str]) -> tuple[str, str]:
-    flags = parse_flags(labels.pop("options.flags", ""))
+def labels_fingerprint(labels: Mapping[str, str], image_id: str) -> str:
+    """Identifies the job definitions that result from a container's labels and the
+    configuration, so that stored jobs can be reused without parsing the labels."""
+    relevant_labels = sorted(
+        (k, v)
+        for k, v in labels.items()
+        if k.startswith(cfg.label_ns) or k in cfg.service_identifiers
+    )
+    configuration = (
+        cfg.default_flags,
+        cfg.default_max,
+        cfg.job_name_regex,
+        cfg.label_ns,
+        cfg.runtime,
+        cfg.schedule_spread,
+        cfg.service_identifiers,
+        cfg.timezone,
+    )
+    return sha256(repr((relevant_labels, image_id, configuration)).encode()).hexdigest()
+
+
+def parse_options(labels: dict[str, str]) -> tuple[str, str, Optional[int]]:
+    flags = parse_flags_option(labels)
+    labels.pop("options.flags", None)
     user = labels.pop(cfg.label_ns + "options.user", "")
-    return flags, user
+    concurrency = parse_concurrency(
+        labels.pop(cfg.label_ns + "options.concurrency", "")
+    )
+    return flags, user, concurrency
+
+
+def parse_concurrency(value: str) -> Optional[int]:
+    if not value:
+        return None
+    try:
+        result = int(value)
+        if result < 1:
+            raise ValueError
+    except ValueError:
+        log.error(f'Invalid concurrency option: {value}')
+        return None
+    return result
+
+
+def parse_flags_option(labels: Mapping[str, str]) -> str:
+    """Returns the flags that :func:`parse_labels` derives from the labels in the
+    label namespace."""
+    return parse_flags(labels.get("options.flags", ""))
 
 
 @lru_cache(maxsize=16)
@@ -180,13 +456,13 @@ def parse_flags(options: str) -> str:
             else:
                 result.add(option)
     result_string = ','.join(sorted(result))
-    log.debug(f'Parsed & resolved container flags: {result_string}')
+    log.debug('Parsed & resolved container flags: %s', result_string)
     return result_string
 
 
 def parse_service_id(labels: dict[str, str]) -> tuple[str, ...]:
     filtered_labels = {k: v for k, v in labels.items() if k in cfg.service_identifiers}
-    log.debug(f'Considering labels for service id: {filtered_labels}')
+    log.debug('Considering labels for service id: %s', filtered_labels)
     if not filtered_labels:
         return ()
 
@@ -201,13 +477,18 @@ def parse_service_id(labels: dict[str, str]) -> tuple[str, ...]:
     return tuple(f"{k}={v}" for k, v in filtered_labels.items())
 
 
-def image_definition_labels_of_container(container_id: str) -> dict[str, str]:
-    labels = cfg.client.containers.get(container_id).image.labels
-    return {k: v for k, v in labels.items() if k.startswith(cfg.label_ns)}
+# an image's id is derived from its configuration, hence the labels are immutable and
+# the cache is only cleared to release deleted images' data
+@lru_cache(maxsize=CONTAINER_CACHE_SIZE)
+def image_definition_labels(image_id: str) -> Mapping[str, str]:
+    labels = cfg.client.api.inspect_image(image_id)['Config']['Labels'] or {}
+    return MappingProxyType(
+        {k: v for k, v in labels.items() if k.startswith(cfg.label_ns)}
+    )
 
 
 def parse_job_definitions(labels: Mapping[str, str], user: str) -> dict[str, dict]:
-    log.debug(f'Considering labels for job definitions: {dict(labels)}')
+    log.debug('Considering labels for job definitions: %s', dict(labels))
 
     name_grouped_definitions: defaultdict[str, dict[str, str | dict]] = defaultdict(
         dict
@@ -225,34 +506,76 @@ def parse_job_definitions(labels: Mapping[str, str], user: str) -> dict[str, dic
             name, attribute = key.split('.', 1)
             name_grouped_definitions[name][attribute] = value
 
-    log.debug(f'Job definitions: {dict(name_grouped_definitions)}')
+    log.debug('Job definitions: %s', dict(name_grouped_definitions))
 
-    result = {}
+    result: dict[str, dict] = {}
     for name, definition in name_grouped_definitions.items():
-        log.debug(f'Processing {name}')
+        log.debug('Processing %s', name)
         definition['name'] = name
         definition.setdefault("user", user)
 
-        job = job_config_validator.validated(definition)
+        job, errors = validate_job_definition(
+            tuple(
+                sorted(
+                    (k, tuple(sorted(v.items())) if isinstance(v, dict) else v)
+                    for k, v in definition.items()
+                )
+            )
+        )
         if job is None:
             log.error(f'Misconfigured job definition: {definition}')
-            log.error(f'Errors: {job_config_validator.errors}')
+            log.error(f'Errors: {errors}')
             continue
 
-        for trigger_name in ('cron', 'date', 'interval'):
-            trigger = job.pop(trigger_name, None)
-            if trigger is None:
-                continue
+        # the cached definition must not be altered
+        result[name] = dict(job) | {'environment': dict(job['environment'])}
 
-            job['trigger'] = trigger
+    return result
 
-        log.debug(f'Normalized definition: {job}')
-        result[name] = job
 
-    return result
+# replicas and restarted containers mostly carry the same definitions, the cache's
+# statistics are available via validate_job_definition.cache_info()
+@lru_cache(maxsize=CONTAINER_CACHE_SIZE)
+def validate_job_definition(
+    items: tuple[tuple[str, str | tuple[tuple[str, str], ...]], ...]
+) -> tuple[Optional[Mapping], dict]:
+    definition = {
+        k: dict(v) if k == 'environment' and isinstance(v, tuple) else v
+        for k, v in items
+    }
+    validator = (
+        job_config_validator
+        if cfg.job_validator == 'cerberus'
+        else compiled_job_config_validator
+    )
+
+    with validation_lock:
+        job = validator.validated(definition)
+        errors = validator.errors
+    if job is None:
+        return None, errors
+
+    for trigger_name in ('cron', 'date', 'interval'):
+        trigger = job.pop(trigger_name, None)
+        if trigger is None:
+            continue
+
+        job['trigger'] = trigger
+
+    job['environment'] = MappingProxyType(job['environment'])
+    log.debug('Normalized definition: %s', job)
+    return MappingProxyType(job), {}
 
 
 ####
 
 
-__all__ = ("parse_labels",)
+__all__ = (
+    "cached_trigger",
+    "create_trigger",
+    "image_definition_labels",
+    "labels_fingerprint",
+    "parse_labels",
+    "ParsedLabels",
+    "validate_job_definition",
+)
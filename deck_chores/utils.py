@@ -1,6 +1,8 @@
+import json
 import logging
 import os
 import sys
+from datetime import datetime, timezone
 from functools import lru_cache
 from types import SimpleNamespace
 from typing import Final, Optional
@@ -17,7 +19,13 @@ TIME_UNIT_MULTIPLIERS: Final = {
     'd': 1 * 60 * 60 * 24,
     'w': 1 * 60 * 60 * 24 * 7,
 }
+SIZE_UNIT_MULTIPLIERS: Final = {'k': 2**10, 'm': 2**20, 'g': 2**30}
 UUID_NAMESPACE: Final = uuid5(NAMESPACE_DNS, "deck-chores.readthedocs.io")
+# anything else in a record's namespace was passed as extra field
+LOG_RECORD_ATTRIBUTES: Final = frozenset(vars(logging.makeLogRecord({}))) | {
+    'asctime',
+    'message',
+}
 
 
 ####
@@ -31,6 +39,26 @@ class ExcludeErrorsFilter(logging.Filter):
         return record.levelno < self.threshold
 
 
+class JSONFormatter(logging.Formatter):
+    """Formats a record as JSON object on a single line with the fields that were
+    passed as ``extra``."""
+
+    def format(self, record):
+        result = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(
+                timespec='milliseconds'
+            ),
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in LOG_RECORD_ATTRIBUTES:
+                result[name] = value
+        if record.exc_info:
+            result['exception'] = self.formatException(record.exc_info)
+        return json.dumps(result, default=str)
+
+
 @lru_cache(maxsize=64)
 def generate_id(*args) -> str:
     return str(uuid5(UUID_NAMESPACE, ''.join(args)))
@@ -70,6 +98,13 @@ def parse_time_from_string_with_units(value: str) -> Optional[int]:
     return int(result)
 
 
+def parse_size(value: str) -> int:
+    value = value.strip()
+    if value and (multiplier := SIZE_UNIT_MULTIPLIERS.get(value[-1].lower())):
+        return int(float(value[:-1]) * multiplier)
+    return int(value)
+
+
 @lru_cache(maxsize=64)
 def seconds_as_interval_tuple(value: int) -> tuple[int, int, int, int, int]:
     weeks, value = divmod(value, TIME_UNIT_MULTIPLIERS['w'])
@@ -80,7 +115,11 @@ def seconds_as_interval_tuple(value: int) -> tuple[int, int, int, int, int]:
 
 
 def configure_logging(cfg: SimpleNamespace):  # pragma: nocover
-    log_formatter = logging.Formatter(cfg.logformat, style='{')
+    log_formatter: logging.Formatter
+    if cfg.logformat == 'json':
+        log_formatter = JSONFormatter()
+    else:
+        log_formatter = logging.Formatter(cfg.logformat, style='{')
     stdout_log_handler.setFormatter(log_formatter)
 
     if not cfg.stderr_level:
@@ -5,10 +5,18 @@ from docker.client import DockerClient
 import pytest
 
 from deck_chores.indexes import (
+    _container_id_by_job_id,
+    _container_states,
+    _job_ids_by_container_id,
     _service_locks_by_container_id,
     _service_locks_by_service_id,
+    container_name,
+)
+from deck_chores.parsers import (
+    image_definition_labels,
+    job_config_validator,
+    parse_flags,
 )
-from deck_chores.parsers import job_config_validator
 from deck_chores.utils import split_string
 
 
@@ -18,15 +26,32 @@ def cfg(mocker):
 
     cfg.client = mocker.MagicMock(DockerClient)
     cfg.client.api = mocker.MagicMock(APIClient)
+    cfg.container_state_checks = 'cached'
     cfg.debug = True
     cfg.default_max = 1
     cfg.default_flags = split_string('image,service', sort=True)
     cfg.default_user = 'root'
+    cfg.events_debounce = 0
+    cfg.events_reconnect_attempts = 1
+    cfg.inspection_workers = 1
+    cfg.job_concurrency = 0
     cfg.job_executor_namespace = 10
+    cfg.job_execution = 'blocking'
     cfg.job_name_regex = "[a-z0-9-]+"
+    cfg.job_store = ''
+    cfg.job_validator = 'compiled'
     cfg.label_ns = 'deck-chores.'
+    cfg.logformat = '{asctime}|{levelname:8}|{message}'
+    cfg.metrics_port = 0
+    cfg.misfire_grace_time = 1
+    cfg.output_queue_size = 0
+    cfg.reconciliation_interval = 0
+    cfg.runtime = 'threads'
+    cfg.schedule_spread = 0
+    cfg.service_concurrency = 0
     cfg.service_identifiers = split_string('project_id,service_id')
     cfg.timezone = 'UTC'
+    cfg.timings_file = ''
 
     job_config_validator.set_defaults(cfg)
 
@@ -40,5 +65,12 @@ def fixtures():
 
 @pytest.fixture(autouse=True)
 def sanitize_indexes():
+    _container_id_by_job_id.clear()
+    _container_states.clear()
+    _job_ids_by_container_id.clear()
     _service_locks_by_container_id.clear()
     _service_locks_by_service_id.clear()
+    container_name.cache_clear()
+    image_definition_labels.cache_clear()
+    # the flags are resolved with the default flags that tests may alter
+    parse_flags.cache_clear()
@@ -0,0 +1,132 @@
+from types import SimpleNamespace
+
+from apscheduler.executors.base import BaseExecutor
+from apscheduler.executors.pool import ThreadPoolExecutor
+import pytest
+
+from deck_chores import admission, metrics
+from deck_chores.admission import (
+    AdmittingThreadPoolExecutor,
+    discard_queued,
+    hand_over,
+    queue_wait_report,
+    release,
+    submit,
+)
+
+
+class FakeExecutor:
+    def __init__(self):
+        self.dispatched = []
+        self.dropped = []
+
+    def dispatch(self, job, run_times):
+        self.dispatched.append(job)
+
+    def drop(self, job_id):
+        self.dropped.append(job_id)
+
+
+def job(job_id: str, service: str, **definition) -> SimpleNamespace:
+    return SimpleNamespace(
+        id=job_id,
+        kwargs={
+            'container_id': f'{service}-container',
+            'job_id': job_id,
+            'job_name': 'test',
+            'service_id': (f'service={service}',),
+        }
+        | definition,
+        misfire_grace_time=1,
+        _jobstore_alias='default',
+        _scheduler=None,
+    )
+
+
+@pytest.fixture(autouse=True)
+def sanitize_admission(mocker):
+    for name in ('_running', '_admitted', '_handed_over', '_queues'):
+        getattr(admission, name).clear()
+    for waits in admission._waits.values():
+        waits.clear()
+    for name in ('increment', 'observe', 'record_timing'):
+        mocker.patch(f'deck_chores.metrics.{name}')
+
+
+def test_fair_queue(cfg):
+    cfg.job_concurrency = 2
+    cfg.service_concurrency = 2
+    executor = FakeExecutor()
+
+    for job_id in ('a1', 'a2', 'a3', 'a4', 'a5'):
+        submit(executor, job(job_id, 'a'), [])
+    submit(executor, job('b1', 'b'), [])
+    assert [j.id for j in executor.dispatched] == ['a1', 'a2']
+
+    for job_id in ('a1', 'a2', 'a3'):
+        release(job_id)
+    # the queued services take turns
+    assert [j.id for j in executor.dispatched] == ['a1', 'a2', 'a3', 'b1', 'a4']
+    # the time a submission was queued doesn't count as misfire
+    assert executor.dispatched[2].misfire_grace_time > 1
+    assert dict(admission._running) == {('service=a',): 1, ('service=b',): 1}
+
+    discard_queued('a5')
+    assert executor.dropped == ['a5']
+    assert not admission._queues
+
+
+def test_service_limit_from_label(cfg):
+    executor = FakeExecutor()
+
+    for job_id in ('c1', 'c2'):
+        submit(executor, job(job_id, 'c', concurrency=1), [])
+    submit(executor, job('d1', 'd'), [])
+    assert [j.id for j in executor.dispatched] == ['c1', 'd1']
+
+    hand_over('c1')
+    # the executor's return from a watched execution doesn't release it
+    release('c1')
+    assert [j.id for j in executor.dispatched] == ['c1', 'd1']
+    release('c1', handed_over=True)
+    assert [j.id for j in executor.dispatched] == ['c1', 'd1', 'c2']
+
+
+def test_priorities(cfg):
+    cfg.job_concurrency = 1
+    executor = FakeExecutor()
+
+    submit(executor, job('l1', 'a', priority='low'), [])
+    submit(executor, job('l2', 'a', priority='low'), [])
+    submit(executor, job('n1', 'b'), [])
+    # it precedes the queued submission of the same service
+    submit(executor, job('h1', 'a', priority='high'), [])
+    submit(executor, job('h2', 'c', priority='high'), [])
+
+    for job_id in ('l1', 'h1', 'h2', 'n1'):
+        release(job_id)
+    assert [j.id for j in executor.dispatched] == ['l1', 'h1', 'h2', 'n1', 'l2']
+
+    report = queue_wait_report()
+    assert report['high']['count'] == 2
+    assert report['normal']['count'] == 1
+    assert report['low']['count'] == 1
+
+
+def test_running_gauge_counts_dispatched_runs(cfg, mocker):
+    cfg.job_concurrency = 1
+    mocker.patch.object(ThreadPoolExecutor, '_do_submit_job')
+    mocker.patch.object(BaseExecutor, '_run_job_success')
+    executor = AdmittingThreadPoolExecutor()
+
+    executor._do_submit_job(job('a1', 'a'), [])
+    executor._do_submit_job(job('a2', 'a'), [])
+    discard_queued('a2')
+    executor._run_job_success('a1', [])
+
+    # the queued and dropped run isn't accounted as running
+    assert [
+        c.args[1:]
+        for c in metrics.increment.call_args_list
+        if c.args[0] == "deck_chores_jobs_running"
+    ] == [(), (-1,)]
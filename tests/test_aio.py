@@ -0,0 +1,271 @@
+import asyncio
+import json
+import struct
+from urllib.parse import parse_qs, urlsplit
+
+from apscheduler.events import EVENT_JOB_EXECUTED
+from apscheduler.triggers.interval import IntervalTrigger
+from docker.errors import APIError
+import pytest
+
+from deck_chores import aio, jobs
+from deck_chores.aio import (
+    AsyncDockerClient,
+    exec_job,
+    inspect_running_containers,
+    listen,
+    subscribe_to_events,
+)
+from deck_chores.main import EVENTS_FILTERS
+
+
+def frame(stream_type: int, payload: bytes) -> bytes:
+    return struct.pack(">BxxxL", stream_type, len(payload)) + payload
+
+
+class FakeDaemon:
+    """Serves the given responses per method and path on a unix socket and records
+    the received requests. A response is either a JSON document, a tuple of chunks
+    that are sent with chunked transfer encoding or raw bytes that are followed by
+    closing the connection."""
+
+    def __init__(self, responses: dict):
+        self.requests: list[tuple[str, str, dict, object]] = []
+        self.responses = responses
+
+    async def handle(self, reader, writer):
+        method, target, _ = (await reader.readline()).decode().split(" ", 2)
+        headers = {}
+        while (line := await reader.readline()) != b"\r\n":
+            name, _, value = line.decode().partition(":")
+            headers[name.lower()] = value.strip()
+        content = await reader.readexactly(int(headers.get("content-length", 0)))
+
+        url = urlsplit(target)
+        self.requests.append(
+            (
+                method,
+                url.path,
+                parse_qs(url.query),
+                json.loads(content) if content else None,
+            )
+        )
+
+        response = self.responses.get((method, url.path))
+        if response is None:
+            body = json.dumps({"message": "No such thing"}).encode()
+            writer.write(
+                b"HTTP/1.1 404 Not Found\r\nContent-Type: application/json\r\n"
+                + f"Content-Length: {len(body)}\r\n\r\n".encode()
+                + body
+            )
+        elif isinstance(response, bytes):
+            writer.write(b"HTTP/1.1 200 OK\r\n\r\n" + response)
+        elif isinstance(response, tuple):
+            writer.write(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n")
+            for chunk in response:
+                writer.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+                await writer.drain()
+            writer.write(b"0\r\n\r\n")
+        else:
+            body = json.dumps(response).encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                + f"Content-Length: {len(body)}\r\n\r\n".encode()
+                + body
+            )
+
+        await writer.drain()
+        writer.close()
+
+
+@pytest.fixture
+def fake_daemon(tmp_path, monkeypatch):
+    socket_path = str(tmp_path / "docker.sock")
+
+    async def serve(responses: dict, scenario):
+        daemon = FakeDaemon(responses)
+        server = await asyncio.start_unix_server(daemon.handle, socket_path)
+        monkeypatch.setattr(aio, "client", AsyncDockerClient(socket_path))
+        async with server:
+            return daemon, await scenario()
+
+    return lambda responses, scenario: asyncio.run(serve(responses, scenario))
+
+
+def test_request(fake_daemon):
+    async def scenario():
+        result = await aio.client.request("GET", "/containers/json")
+        with pytest.raises(APIError, match="No such thing"):
+            await aio.client.request("GET", "/containers/void/json")
+        return result
+
+    _, result = fake_daemon({("GET", "/containers/json"): [{"Id": "a"}]}, scenario)
+    assert result == [{"Id": "a"}]
+
+
+def test_api_version_prefix(fake_daemon):
+    async def scenario():
+        client = AsyncDockerClient(aio.client.socket_path, "1.41")
+        return await client.request("GET", "/containers/json")
+
+    _, result = fake_daemon({("GET", "/v1.41/containers/json"): []}, scenario)
+    assert result == []
+
+
+def test_subscribe_to_events(cfg, fake_daemon):
+    events = [
+        {"Type": "container", "Action": "start", "Actor": {"ID": "a"}, "timeNano": 1},
+        {"Type": "container", "Action": "die", "Actor": {"ID": "a"}, "timeNano": 2},
+    ]
+    # an event may be split over chunks and a chunk may contain multiple events
+    encoded = b"".join(json.dumps(e).encode() + b"\n" for e in events)
+    chunks = (encoded[:10], encoded[10:-5], encoded[-5:])
+
+    async def scenario():
+        queue = await subscribe_to_events()
+        return [await queue.get() for _ in range(len(events) + 1)]
+
+    daemon, result = fake_daemon({("GET", "/events"): chunks}, scenario)
+
+    # the events that the daemon repeats after the reconnection are dropped
+    assert result == events + [None]
+    _, _, params, _ = daemon.requests[0]
+    assert json.loads(params["filters"][0]) == EVENTS_FILTERS
+    _, _, params, _ = daemon.requests[1]
+    assert params["since"] == ["0.000000002"]
+
+
+def test_exec_job(caplog, cfg, fake_daemon):
+    output = frame(1, b"foo\n") + frame(2, b"bar\n") + frame(1, b"baz\n")
+    caplog.set_level("INFO", logger="deck_chores")
+
+    async def scenario():
+        return await exec_job(
+            job_id="j",
+            job_name="test",
+            container_id="a",
+            command="sh -c 'echo foo'",
+            user="",
+            environment={"FOO": "bar"},
+            workdir="/tmp",
+        )
+
+    daemon, result = fake_daemon(
+        {
+            ("GET", "/containers/a/json"): {
+                "Name": "/foo",
+                "State": {"Status": "running"},
+            },
+            ("POST", "/containers/a/exec"): {"Id": "e"},
+            ("POST", "/exec/e/start"): output,
+            ("GET", "/exec/e/json"): {"ExitCode": 3},
+        },
+        scenario,
+    )
+
+    assert result == 3
+    assert caplog.messages[-6:] == [
+        "foo: test: == BEGIN of captured stdout & stderr ==",
+        "foo: test: foo",
+        "foo: test: bar",
+        "foo: test: baz",
+        "foo: test: == END of captured stdout & stderr ====",
+        "Command `sh -c 'echo foo'` in container a finished with exit code 3.",
+    ]
+    _, _, _, config = daemon.requests[1]
+    assert config["Cmd"] == ["sh", "-c", "echo foo"]
+    assert config["Env"] == ["FOO=bar"]
+    assert config["WorkingDir"] == "/tmp"
+
+
+def test_exec_job_in_paused_container(cfg, fake_daemon):
+    async def scenario():
+        with pytest.raises(AssertionError, match="paused"):
+            await exec_job(job_id="j", job_name="test", container_id="a")
+
+    daemon, _ = fake_daemon(
+        {
+            ("GET", "/containers/a/json"): {
+                "Name": "/foo",
+                "State": {"Status": "paused"},
+            }
+        },
+        scenario,
+    )
+    assert len(daemon.requests) == 1
+
+
+def test_inspect_running_containers(cfg, fake_daemon, mocker):
+    process = mocker.patch("deck_chores.aio.process_running_containers")
+
+    fake_daemon(
+        {("GET", "/containers/json"): [{"Id": "a", "State": "paused"}]},
+        inspect_running_containers,
+    )
+
+    (containers,), _ = process.call_args
+    assert [(c.id, c.status) for c in containers] == [("a", "paused")]
+
+
+def test_listen(cfg, fake_daemon, mocker):
+    dispatch = mocker.patch("deck_chores.aio.dispatch_event")
+    events = [
+        {"Type": "container", "Action": "pause", "Actor": {"ID": "a"}, "timeNano": 1},
+        {"Type": "container", "Action": "unpause", "Actor": {"ID": "a"}, "timeNano": 2},
+    ]
+    chunks = tuple(json.dumps(e).encode() + b"\n" for e in events)
+
+    async def scenario():
+        await listen(await subscribe_to_events())
+
+    fake_daemon({("GET", "/events"): chunks}, scenario)
+
+    assert [c.args[0] for c in dispatch.call_args_list] == events
+
+
+def test_jobs_on_event_loop(cfg, fake_daemon, monkeypatch):
+    # restores the thread-based scheduler and its job function afterwards
+    monkeypatch.setattr(jobs, "scheduler", jobs.scheduler)
+    monkeypatch.setattr(jobs, "job_function", jobs.job_function)
+    cfg.client.containers.get.return_value.name = "foo"
+    definition = {
+        'command': 'true',
+        'environment': {},
+        'max': 1,
+        'timezone': 'UTC',
+        'trigger': (IntervalTrigger, (0, 0, 0, 0, 1)),
+        'jitter': None,
+        'user': '',
+    }
+    executed = []
+
+    async def scenario():
+        jobs.use_event_loop(asyncio.get_running_loop(), exec_job)
+        jobs.add("a", {"foo": definition})
+        jobs.start_scheduler()
+        jobs.scheduler.add_listener(
+            lambda event: executed.append(event.retval), EVENT_JOB_EXECUTED
+        )
+
+        async def executions():
+            while not executed:
+                await asyncio.sleep(0.1)
+
+        await asyncio.wait_for(executions(), timeout=5)
+        jobs.scheduler.shutdown(wait=False)
+
+    fake_daemon(
+        {
+            ("GET", "/containers/a/json"): {
+                "Name": "/foo",
+                "State": {"Status": "running"},
+            },
+            ("POST", "/containers/a/exec"): {"Id": "e"},
+            ("POST", "/exec/e/start"): frame(1, b"done\n"),
+            ("GET", "/exec/e/json"): {"ExitCode": 0},
+        },
+        scenario,
+    )
+
+    assert executed == [0]
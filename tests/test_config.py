@@ -25,18 +25,34 @@ def test_default_config(monkeypatch):
     assert isinstance(result.pop('client'), docker.client.DockerClient)
     assert result == {
         'client_timeout': DEFAULT_TIMEOUT_SECONDS,
+        'container_state_checks': 'cached',
         'docker_host': 'unix://var/run/docker.sock',
         'debug': False,
         'default_max': 1,
         'default_flags': ('image', 'service'),
+        'events_debounce': 0,
+        'events_reconnect_attempts': 8,
+        'inspection_workers': 1,
         'job_executor_pool_size': 10,
+        'job_concurrency': 0,
+        'job_execution': 'blocking',
         'job_name_regex': '[a-z0-9-]+',
+        'job_store': '',
+        'job_validator': 'compiled',
         'label_ns': 'deck-chores.',
         'logformat': '{asctime}|{levelname:8}|{message}',
+        'metrics_port': 0,
+        'misfire_grace_time': 1,
+        'output_queue_size': 256,
+        'reconciliation_interval': 300,
+        'service_concurrency': 0,
         'service_identifiers': (
             'com.docker.compose.project',
             'com.docker.compose.service',
         ),
+        'runtime': 'threads',
+        'schedule_spread': 0,
         'stderr_level': 0,
+        'timings_file': '',
         'timezone': 'UTC',
     }
@@ -0,0 +1,147 @@
+import json
+import logging
+import socket
+import struct
+from threading import Event
+from time import sleep
+
+from deck_chores import executions
+from deck_chores.executions import (
+    captured_output,
+    CapturedOutput,
+    COLLECTED_OUTPUT_LIMIT,
+    handle_output,
+    join_output_handling,
+    log_exit_code,
+    reserve_execution,
+    running_executions,
+    watch,
+)
+from deck_chores.utils import JSONFormatter
+
+
+def frame(stream_type: int, payload: bytes) -> bytes:
+    return struct.pack(">BxxxL", stream_type, len(payload)) + payload
+
+
+def test_captured_output_is_limited(caplog):
+    output = CapturedOutput(limit=10)
+
+    with caplog.at_level('INFO', logger='deck_chores'):
+        for chunk in (b'0123\n56', b'789abc\n', b'def\n'):
+            output.feed(chunk)
+        output.close()
+
+    assert caplog.messages == [
+        "== BEGIN of captured stdout & stderr ==",
+        "0123",
+        "56789",
+        "== TRUNCATED, 8 bytes omitted ==",
+        "== END of captured stdout & stderr ====",
+    ]
+    assert output.buffer == b''
+
+
+def test_watched_executions(caplog, cfg):
+    cfg.client.api.exec_inspect.return_value = {'ExitCode': 0}
+    cfg.client.containers.get.return_value.name = 'c'
+    definitions = [
+        {'command': 'x', 'container_id': 'c', 'job_id': f'j{i}', 'job_name': 'n'}
+        for i in range(3)
+    ]
+    daemon_sockets = []
+
+    with caplog.at_level('INFO', logger='deck_chores'):
+        for i, definition in enumerate(definitions):
+            assert reserve_execution(definition['job_id'], 1)
+            attached, daemon_socket = socket.socketpair()
+            watch(definition, f'e{i}', attached)
+            daemon_sockets.append(daemon_socket)
+        assert not reserve_execution('j0', 1)
+
+        # a frame may be split across reads
+        output = frame(1, b'foo\n')
+        daemon_sockets[1].sendall(output[:5])
+        sleep(0.1)
+        daemon_sockets[1].sendall(output[5:])
+        for daemon_socket in reversed(daemon_sockets):
+            daemon_socket.close()
+
+        for _ in range(50):
+            if not any(running_executions(d['job_id']) for d in definitions):
+                break
+            sleep(0.1)
+
+    assert not any(running_executions(d['job_id']) for d in definitions)
+    assert 'c: n: foo' in caplog.messages
+    assert (
+        caplog.messages.count('Command `x` in container c finished with exit code 0.')
+        == 3
+    )
+    assert cfg.client.api.exec_inspect.call_count == 3
+
+
+def test_structured_execution_record(caplog):
+    output = CapturedOutput(limit=10, collect=True)
+    definition = {'command': 'x', 'container_id': 'c', 'job_id': 'j', 'job_name': 'n'}
+
+    with caplog.at_level('INFO', logger='deck_chores'):
+        for chunk in (b'0123\n56', b'789abc\n', b'def\n'):
+            output.feed(chunk)
+        output.close()
+        log_exit_code(definition, 1, output)
+
+    # all is in a single record
+    (record,) = caplog.records
+    assert record.levelno == logging.CRITICAL
+    fields = json.loads(JSONFormatter().format(record))
+    assert fields.pop('time').endswith('+00:00')
+    assert fields == {
+        'level': 'CRITICAL',
+        'message': 'Command `x` in container c finished with exit code 1.',
+        'job_id': 'j',
+        'job_name': 'n',
+        'container_id': 'c',
+        'command': 'x',
+        'exit_code': 1,
+        'output': '0123\n56789',
+        'output_omitted_bytes': 8,
+    }
+
+
+def test_collected_output_is_limited_by_default(cfg):
+    cfg.logformat = 'json'
+    output = captured_output({})
+
+    output.feed(b'x' * COLLECTED_OUTPUT_LIMIT + b'yz')
+    output.close()
+
+    assert len(output.collected[0]) == COLLECTED_OUTPUT_LIMIT
+    assert output.omitted == 2
+    assert captured_output({'output_limit': 4}).remaining == 4
+
+
+def test_output_handling_is_bounded(caplog, cfg, monkeypatch):
+    cfg.output_queue_size = 1
+    monkeypatch.setattr(executions, '_output_queue', None)
+    output = CapturedOutput()
+    unblock = Event()
+
+    with caplog.at_level('INFO', logger='deck_chores'):
+        assert handle_output(unblock.wait)
+        # the handler is busy, one item fits into the queue
+        for _ in range(50):
+            if handle_output(output.feed, b'foo\n', block=False):
+                break
+            sleep(0.01)
+        assert not handle_output(output.feed, b'bar\n', block=False)
+        unblock.set()
+        assert handle_output(output.close)
+        join_output_handling()
+
+    assert caplog.messages == [
+        "== BEGIN of captured stdout & stderr ==",
+        "foo",
+        "== END of captured stdout & stderr ====",
+    ]
+    assert {r.threadName for r in caplog.records} == {'output-handler'}
@@ -1,24 +1,55 @@
+from datetime import datetime, timedelta, timezone
 from time import sleep
+from types import SimpleNamespace
 
+from apscheduler import events
+from apscheduler.triggers.cron import CronTrigger
 from apscheduler.triggers.interval import IntervalTrigger
 from docker.models.containers import Container
+import pytest
 
-from deck_chores.jobs import add, scheduler, start_scheduler
+from deck_chores import metrics
+from deck_chores.executions import release_execution
+from deck_chores.indexes import job_ids_by_container_id, set_container_state
+from deck_chores.jobs import (
+    add,
+    exec_job,
+    get_jobs_for_container,
+    on_executed,
+    on_removed,
+    record_start,
+    scheduler,
+    start_scheduler,
+    state_check_statistics,
+)
+
+
+def job_definition() -> dict:
+    return {
+        'command': 'true',
+        'environment': {},
+        'job_id': 'j',
+        'max': 1,
+        'timezone': 'UTC',
+        'trigger': (IntervalTrigger, (0, 0, 0, 1, 0)),
+        'jitter': None,
+        'user': '',
+    }
 
 
 # TODO silence logger
 def test_job_execution(capsys, cfg, mocker):
     container = mocker.MagicMock(Container)
     container.name = 'foo_0'
-    container.exec_run.return_value = (0, b'')
+    container.status = 'running'
     cfg.client.containers.get.return_value = container
+    cfg.client.api.exec_create.return_value = {'Id': 'e'}
+    cfg.client.api.exec_start.return_value = iter(())
+    cfg.client.api.exec_inspect.return_value = {'ExitCode': 0}
 
-    def docker_containers(filters=None):
-        if filters['status'] == 'paused':
-            return []
-
-        if filters['status'] == 'running':
-            return [container]
+    def docker_containers(all=False, filters=None, sparse=False):
+        assert filters == {'id': 'void'}
+        return [container]
 
     start_scheduler()
 
@@ -40,6 +71,190 @@ def test_job_execution(capsys, cfg, mocker):
 
     scheduler.shutdown(wait=False)
 
-    container.exec_run.assert_has_calls(
-        2 * [mocker.call(cmd='sleep 2', user='test', environment={}, workdir=None)]
+    cfg.client.api.exec_create.assert_has_calls(
+        2
+        * [
+            mocker.call(
+                'void', cmd='sleep 2', user='test', environment={}, workdir=None
+            )
+        ]
+    )
+
+
+def test_job_execution_with_cached_container_state(cfg, mocker):
+    cfg.client.api.exec_create.return_value = {'Id': 'e'}
+    cfg.client.api.exec_start.return_value = iter(())
+    cfg.client.api.exec_inspect.return_value = {'ExitCode': 0}
+    set_container_state('void', 'running')
+    state_check_statistics.clear()
+
+    result = exec_job(container_id='void', job_name='foo', **job_definition())
+
+    assert result == 0
+    cfg.client.containers.list.assert_not_called()
+    assert state_check_statistics == {'cached': 1}
+
+    set_container_state('void', 'paused')
+    with pytest.raises(AssertionError, match='paused'):
+        exec_job(container_id='void', job_name='foo', **job_definition())
+
+
+def test_job_execution_with_verified_container_state(cfg, mocker):
+    cfg.container_state_checks = 'api'
+    cfg.client.containers.list.return_value = [
+        mocker.MagicMock(Container, status='exited')
+    ]
+    set_container_state('void', 'running')
+    state_check_statistics.clear()
+
+    with pytest.raises(AssertionError, match='not running'):
+        exec_job(container_id='void', job_name='foo', **job_definition())
+    cfg.client.containers.list.assert_called_once_with(
+        all=True, filters={'id': 'void'}, sparse=True
     )
+    cfg.client.api.exec_create.assert_not_called()
+    assert state_check_statistics == {'verified': 1}
+
+
+def test_streamed_output(cfg, caplog):
+    cfg.client.api.exec_create.return_value = {'Id': 'e'}
+    cfg.client.api.exec_start.return_value = iter((b'foo\nb', b'ar\r\nbaz', b'\n'))
+    cfg.client.api.exec_inspect.return_value = {'ExitCode': 1}
+    cfg.client.containers.get.return_value.name = 'vacuum'
+    set_container_state('void', 'running')
+
+    with caplog.at_level('INFO', logger='deck_chores'):
+        result = exec_job(container_id='void', job_name='foo', **job_definition())
+
+    assert result == 1
+    # the lines are attributed to the execution as they may interleave with others
+    assert caplog.messages[-6:] == [
+        "vacuum: foo: == BEGIN of captured stdout & stderr ==",
+        "vacuum: foo: foo",
+        "vacuum: foo: bar",
+        "vacuum: foo: baz",
+        "vacuum: foo: == END of captured stdout & stderr ====",
+        "Command `true` in container void finished with exit code 1.",
+    ]
+    cfg.client.api.exec_start.assert_called_once_with('e', stream=True)
+
+
+def test_watched_execution_returns_when_started(cfg, mocker):
+    cfg.job_execution = 'watched'
+    cfg.client.api.exec_create.return_value = {'Id': 'e'}
+    watch = mocker.patch('deck_chores.jobs.watch')
+    set_container_state('void', 'running')
+    definition = job_definition() | {'job_id': 'j', 'max': 1}
+
+    assert exec_job(container_id='void', job_name='foo', **definition) is None
+    # the first execution is still running
+    assert exec_job(container_id='void', job_name='foo', **definition) is None
+
+    cfg.client.api.exec_create.assert_called_once()
+    cfg.client.api.exec_start.assert_called_once_with('e', socket=True)
+    watch.assert_called_once()
+    release_execution('j')
+
+
+def test_get_jobs_for_container_lookup_scales_with_containers_jobs(cfg, mocker):
+    scheduler = mocker.patch("deck_chores.jobs.scheduler")
+    scheduler.get_job.side_effect = lambda job_id: SimpleNamespace(id=job_id)
+
+    for i in range(500):
+        add(f"container-{i}", {f"job-{j}": job_definition() for j in range(8)})
+
+    jobs = list(get_jobs_for_container("container-42"))
+
+    assert len(jobs) == 8
+    assert len({job.id for job in jobs}) == 8
+    # only the container's jobs are looked up, the scheduler's jobs aren't scanned
+    scheduler.get_jobs.assert_not_called()
+    assert scheduler.get_job.call_count == 8
+
+
+def test_triggers_are_shared(cfg, mocker):
+    scheduler = mocker.patch("deck_chores.jobs.scheduler")
+    cron = job_definition() | {
+        'trigger': (CronTrigger, ('*', '*', '*', '*', '*', '*', '*/5', '0')),
+        'jitter': 60,
+    }
+
+    for container_id in ("a", "b"):
+        add(container_id, {"cron": dict(cron), "interval": job_definition()})
+
+    triggers = [c.kwargs["trigger"] for c in scheduler.add_job.call_args_list]
+    assert triggers[0] is triggers[2]
+    assert triggers[0].jitter == 60
+    # an interval starts when its trigger is created
+    assert triggers[1] is not triggers[3]
+
+
+@pytest.mark.parametrize(("window", "peak"), ((0, 60), (0.0005, 60), (300, 7)))
+def test_schedule_spread(cfg, mocker, window, peak):
+    cfg.schedule_spread = window
+    scheduler = mocker.patch("deck_chores.jobs.scheduler")
+    hourly = job_definition() | {
+        'trigger': (CronTrigger, ('*', '*', '*', '*', '*', '*', '0', '0'))
+    }
+
+    for i in range(60):
+        add(f"replica-{i}", {"hourly": dict(hourly)})
+
+    now = datetime(2024, 1, 1, 0, 30, tzinfo=timezone.utc)
+    starts = sorted(
+        c.kwargs["trigger"].get_next_fire_time(None, now)
+        for c in scheduler.add_job.call_args_list
+    )
+    assert now + timedelta(minutes=30) <= starts[0]
+    assert starts[-1] < now + timedelta(minutes=30, seconds=window or 1)
+    # the maximum of executions that would run at the same time if each took ten
+    # seconds
+    assert (
+        max(
+            sum(start <= s < start + timedelta(seconds=10) for s in starts)
+            for start in starts
+        )
+        == peak
+    )
+
+
+def test_job_index_follows_removals(cfg, mocker):
+    mocker.patch("deck_chores.jobs.scheduler")
+    add("a", {"foo": job_definition(), "bar": job_definition()})
+    add("b", {"foo": job_definition()})
+    job_id = next(iter(job_ids_by_container_id["a"]))
+    start_times = mocker.patch.dict("deck_chores.jobs._start_times", clear=True)
+    record_start(job_id)
+    record_start("other")
+
+    on_removed(events.JobEvent(events.EVENT_JOB_REMOVED, job_id, "default"))
+    assert len(job_ids_by_container_id["a"]) == 1
+    assert list(start_times) == ["other"]
+
+    on_removed(events.JobEvent(events.EVENT_ALL_JOBS_REMOVED, None, None))
+    assert not job_ids_by_container_id
+    assert not start_times
+
+
+def test_start_delay(cfg, mocker):
+    record_timing = mocker.patch.object(metrics, "record_timing")
+    mocker.patch("deck_chores.jobs.scheduler")
+    mocker.patch.dict("deck_chores.jobs._start_times", clear=True)
+    set_container_state('void', 'running')
+    cfg.client.api.exec_create.return_value = {'Id': 'e'}
+    cfg.client.api.exec_start.return_value = iter(())
+    cfg.client.api.exec_inspect.return_value = {'ExitCode': 0}
+    scheduled_at = datetime.now(timezone.utc) - timedelta(seconds=2)
+
+    exec_job(container_id='void', job_name='foo', **job_definition())
+    on_executed(
+        events.JobExecutionEvent(
+            events.EVENT_JOB_EXECUTED, 'j', 'default', scheduled_at, retval=0
+        )
+    )
+
+    (kind, job_id, run_time), _ = record_timing.call_args_list[0]
+    assert (kind, job_id) == ("run_time", "j")
+    (kind, job_id, delay), _ = record_timing.call_args_list[1]
+    assert (kind, job_id) == ("start_delay", "j")
+    assert 2 <= delay < 3
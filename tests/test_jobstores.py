@@ -0,0 +1,66 @@
+from datetime import datetime, timedelta, timezone
+
+from apscheduler.jobstores.base import ConflictingIdError, JobLookupError
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.triggers.interval import IntervalTrigger
+import pytest
+
+from deck_chores.jobstores import SQLiteJobStore
+
+
+def function(**kwargs):
+    pass
+
+
+def scheduler_with_store(path) -> BackgroundScheduler:
+    scheduler = BackgroundScheduler(
+        jobstores={"default": SQLiteJobStore(str(path))}, timezone="UTC"
+    )
+    scheduler.start(paused=True)
+    return scheduler
+
+
+def test_jobs_are_persisted(tmp_path):
+    path = tmp_path / "jobs.sqlite"
+    scheduler = scheduler_with_store(path)
+    scheduler.add_job(
+        function,
+        IntervalTrigger(minutes=5),
+        id="a-job",
+        kwargs={"container_id": "a", "fingerprint": "f"},
+    )
+    scheduler.add_job(function, IntervalTrigger(minutes=1), id="b-job")
+    scheduler.get_job("b-job").pause()
+    with pytest.raises(ConflictingIdError):
+        scheduler.add_job(function, IntervalTrigger(minutes=1), id="a-job")
+    scheduler.shutdown(wait=False)
+
+    scheduler = scheduler_with_store(path)
+    jobs = scheduler.get_jobs()
+    # paused jobs are listed last
+    assert [job.id for job in jobs] == ["a-job", "b-job"]
+    assert jobs[0].kwargs == {"container_id": "a", "fingerprint": "f"}
+    assert jobs[0].next_run_time is not None
+    assert jobs[1].next_run_time is None
+
+    jobs[0].remove()
+    assert scheduler.get_job("a-job") is None
+    scheduler.shutdown(wait=False)
+
+
+def test_due_jobs(tmp_path):
+    store = SQLiteJobStore(str(tmp_path / "jobs.sqlite"))
+    scheduler = BackgroundScheduler(jobstores={"default": store}, timezone="UTC")
+    scheduler.start(paused=True)
+    scheduler.add_job(function, IntervalTrigger(minutes=1), id="soon")
+    scheduler.add_job(function, IntervalTrigger(hours=1), id="later")
+
+    now = datetime.now(timezone.utc)
+    assert [j.id for j in store.get_due_jobs(now + timedelta(minutes=2))] == ["soon"]
+    assert store.get_next_run_time() == store.lookup_job("soon").next_run_time
+
+    store.remove_all_jobs()
+    assert store.get_next_run_time() is None
+    with pytest.raises(JobLookupError):
+        store.remove_job("soon")
+    scheduler.shutdown(wait=False)
@@ -1,23 +1,51 @@
+import json
 from datetime import datetime
+from queue import Queue
+from threading import Event, Thread
+from time import sleep
 from types import SimpleNamespace
 
 from apscheduler.job import Job
 from apscheduler.triggers.interval import IntervalTrigger
 from docker.models.containers import Container
-from pytest import mark
-
-from deck_chores.indexes import lock_service
+from pytest import mark, raises
+
+from deck_chores import metrics
+from deck_chores.indexes import (
+    container_states,
+    job_ids_by_container_id,
+    lock_service,
+    register_job,
+    service_locks_by_service_id,
+    set_container_state,
+)
 from deck_chores.main import (
     find_other_container_for_service,
     inspect_running_containers,
+    coalesce_events,
+    dispatch_event,
+    event_statistics,
+    EVENTS_FILTERS,
     listen,
+    read_events,
     reassign_jobs,
+    reconciliation_event,
+    RECONCILIATION_LIMIT,
+    RECONCILIATION_TIME_MARGIN,
+    restore_jobs,
+    report_state,
+    sigusr1_handler,
+    reconcile_periodically,
+    subscribe_to_events,
     there_is_another_deck_chores_container,
     handle_die,
+    handle_image_delete,
     handle_pause,
+    handle_reconcile,
+    handle_restart,
     handle_unpause,
 )
-from deck_chores.parsers import parse_job_definitions
+from deck_chores.parsers import labels_fingerprint, parse_job_definitions
 
 
 @mark.parametrize(
@@ -39,6 +67,8 @@ def test_event_dispatching(cfg, fixtures, mocker):
     cfg.client.events.return_value = (
         (fixtures / "events_00.txt").read_bytes().splitlines()
     )
+    # how events are batched depends on the reader thread's progress
+    mocker.patch("deck_chores.main.coalesce_events", lambda events: events)
 
     definition = parse_job_definitions(
         {'deck-chores.beep.command': '/beep.sh', 'deck-chores.beep.interval': '10m'},
@@ -60,7 +90,7 @@ def test_event_dispatching(cfg, fixtures, mocker):
         mocker.patch("deck_chores.main.reassign_jobs"), "reassign_jobs"
     )
 
-    listen(datetime.utcnow())
+    listen(subscribe_to_events())
 
     _ = mocker.call
     expected_calls = [
@@ -132,6 +162,122 @@ def test_event_dispatching(cfg, fixtures, mocker):
     #     raise AssertionError(f"Missed call: {expected_calls[len(actual_calls)]}")
 
     assert call_recorder.mock_calls == expected_calls
+    # the repeated events after the reconnection are dropped
+    assert cfg.client.events.mock_calls == [
+        mocker.call(
+            filters={
+                "type": ["container", "image"],
+                "event": ["start", "die", "pause", "unpause", "delete"],
+            }
+        ),
+        mocker.call(filters=EVENTS_FILTERS, since="1570390113.887219267"),
+    ]
+
+
+def test_coalesced_event_dispatching(cfg, fixtures, mocker):
+    events = Queue()
+    for line in (fixtures / "events_00.txt").read_bytes().splitlines():
+        event = json.loads(line)
+        # as filtered by the daemon
+        if event["Type"] == "container" and event["Action"] in EVENTS_FILTERS["event"]:
+            events.put(event)
+    events.put(None)
+
+    call_recorder = mocker.Mock()
+    for name in (
+        "handle_start",
+        "handle_restart",
+        "handle_die",
+        "handle_pause",
+        "handle_unpause",
+    ):
+        call_recorder.attach_mock(mocker.patch(f"deck_chores.main.{name}"), name)
+    coalesced = event_statistics["coalesced"]
+
+    listen(events)
+
+    assert [(c[0], c.args[0]["Actor"]["ID"][:3]) for c in call_recorder.mock_calls] == [
+        ("handle_restart", "278"),
+        ("handle_pause", "278"),
+        ("handle_die", "cba"),
+    ]
+    assert event_statistics["coalesced"] == coalesced + 7
+
+
+def test_coalesce_events():
+    def event(action, container_id):
+        return {"Type": "container", "Action": action, "Actor": {"ID": container_id}}
+
+    events = [
+        event("die", "a"),
+        event("start", "a"),
+        event("start", "b"),
+        event("pause", "a"),
+        {"Type": "image", "Action": "delete", "Actor": {"ID": "sha256:b10a"}},
+        event("die", "a"),
+        event("pause", "b"),
+        event("start", "a"),
+        None,
+    ]
+
+    assert coalesce_events(events) == [
+        events[2],
+        events[4],
+        events[6],
+        # a died and was started twice
+        event("restart", "a"),
+        None,
+    ]
+
+    events = [event("die", "a"), event("start", "b"), event("die", "b")]
+    # b may have been listed at startup
+    assert coalesce_events(events) == [event("die", "a"), event("die", "b")]
+
+
+def test_debounced_restart(cfg, mocker):
+    cfg.events_debounce = 0.2
+    handle_start = mocker.patch("deck_chores.main.handle_start")
+    handle_die = mocker.patch("deck_chores.main.handle_die")
+    handle_restart = mocker.patch("deck_chores.main.handle_restart")
+    events = Queue()
+
+    def restart():
+        events.put({"Type": "container", "Action": "die", "Actor": {"ID": "a"}})
+        sleep(0.05)
+        events.put({"Type": "container", "Action": "start", "Actor": {"ID": "a"}})
+        sleep(0.3)
+        events.put(None)
+
+    Thread(target=restart).start()
+    listen(events)
+
+    handle_restart.assert_called_once()
+    handle_die.assert_not_called()
+    handle_start.assert_not_called()
+
+
+@mark.parametrize("has_jobs", (True, False))
+def test_handle_restart(cfg, mocker, has_jobs):
+    process_started_container_labels = mocker.patch(
+        "deck_chores.main.process_started_container_labels"
+    )
+    paused_job, running_job = mocker.MagicMock(spec_set=Job), mocker.MagicMock()
+    paused_job.next_run_time = None
+    mocker.patch(
+        "deck_chores.jobs.get_jobs_for_container",
+        mocker.Mock(return_value=[paused_job, running_job]),
+    )
+    if has_jobs:
+        register_job("job", "a")
+
+    handle_restart({"Actor": {"ID": "a"}})
+
+    if has_jobs:
+        process_started_container_labels.assert_not_called()
+        paused_job.resume.assert_called_once()
+        running_job.resume.assert_not_called()
+    else:
+        process_started_container_labels.assert_called_once_with("a", paused=False)
 
 
 def test_find_other_container_for_service(cfg, mocker):
@@ -186,9 +332,20 @@ def test_handle_die(mocker):
         "deck_chores.jobs.get_jobs_for_container", mocker.Mock(return_value=[job])
     )
 
+    set_container_state("a", "running")
+
     handle_die({"Actor": {"ID": "a"}})
 
     job.remove.assert_called_once()
+    assert "a" not in container_states
+
+
+def test_handle_image_delete(mocker):
+    image_definition_labels = mocker.patch("deck_chores.main.image_definition_labels")
+
+    handle_image_delete({"Actor": {"ID": "sha256:b10a"}})
+
+    image_definition_labels.cache_clear.assert_called_once()
 
 
 def test_handle_pause(mocker):
@@ -201,6 +358,7 @@ def test_handle_pause(mocker):
     handle_pause({"Actor": {"ID": "a"}})
 
     job.pause.assert_called_once()
+    assert container_states["a"] == "paused"
 
 
 def test_handle_unpause(cfg, mocker):
@@ -223,11 +381,12 @@ def test_handle_unpause(cfg, mocker):
 
 
 def test_inspect_running_containers(cfg, mocker):
-    container = SimpleNamespace(id="a", status="running")
+    container = SimpleNamespace(
+        id="a", status="running", attrs={"Names": ["/a"], "Labels": {}}
+    )
     cfg.client.containers.list.return_value = [container]
-    cfg.client.api.inspect_container.return_value = {
-        "State": {"StartedAt": "3000-01-02T01:02:03.456789Z"}
-    }
+    parsed_labels = ((), "image,service", {})
+    mocker.patch("deck_chores.main.parse_labels", return_value=parsed_labels)
 
     process_started_container_labels = mocker.MagicMock()
     mocker.patch(
@@ -235,11 +394,43 @@ def test_inspect_running_containers(cfg, mocker):
         process_started_container_labels,
     )
 
-    assert inspect_running_containers() == datetime(
-        year=3000, month=1, day=2, hour=1, minute=2, second=3, microsecond=456789
+    inspect_running_containers()
+
+    process_started_container_labels.assert_called_once_with(
+        "a", paused=False, parsed_labels=parsed_labels
     )
+    cfg.client.containers.list.assert_called_once_with(ignore_removed=True, sparse=True)
+    cfg.client.api.inspect_container.assert_not_called()
+    assert container_states == {"a": "running"}
+
+
+def test_concurrent_inspection_of_running_containers(cfg, mocker):
+    cfg.inspection_workers = 4
+    containers = [
+        SimpleNamespace(id=str(i), status=("paused" if i % 3 else "running"), attrs={})
+        for i in range(32)
+    ]
+    cfg.client.containers.list.return_value = containers
 
-    process_started_container_labels.assert_called_once_with("a", paused=False)
+    def parse_labels(container_id):
+        sleep(0.001 * (32 - int(container_id)))
+        return (), "", {"job": container_id}
+
+    mocker.patch("deck_chores.main.parse_labels", parse_labels)
+    process_started_container_labels = mocker.MagicMock()
+    mocker.patch(
+        "deck_chores.main.process_started_container_labels",
+        process_started_container_labels,
+    )
+
+    inspect_running_containers()
+
+    assert process_started_container_labels.mock_calls == [
+        mocker.call(
+            c.id, paused=c.status == "paused", parsed_labels=((), "", {"job": c.id})
+        )
+        for c in containers
+    ]
 
 
 @mark.parametrize(
@@ -274,6 +465,7 @@ def test_reassign_jobs(
     mocker.patch("deck_chores.jobs.get_jobs_for_container", get_jobs_for_container)
 
     lock_service(("project_id=foo", "service_id=bar"), "a")
+    register_job("job", "a")
 
     assert reassign_jobs("a", consider_paused=True) == "b"
     find_other_container_for_service.assert_called_once_with("a", True)
@@ -284,3 +476,205 @@ def test_reassign_jobs(
 
     job_kwargs_union.assert_called_once_with({"container_id": "b"})
     job.modify.assert_called_once_with(kwargs=job_kwargs_union.return_value)
+    assert job_ids_by_container_id == {"b": {"job"}}
+
+
+def test_restore_jobs(cfg, mocker):
+    labels = {"deck-chores.beep.command": "/beep.sh", "service_id": "beep"}
+    containers = [
+        SimpleNamespace(
+            id=container_id,
+            status=status,
+            attrs={"Labels": labels, "ImageID": "sha256:b10a"},
+        )
+        for container_id, status in (("a", "paused"), ("b", "running"))
+    ]
+    fingerprint = labels_fingerprint(labels, "sha256:b10a")
+    stored_jobs = []
+    for job_id, container_id, job_fingerprint in (
+        ("a-beep", "a", fingerprint),
+        ("b-beep", "b", "outdated"),
+        ("c-beep", "c", fingerprint),
+    ):
+        job = mocker.MagicMock(spec_set=Job)
+        job.id = job_id
+        job.kwargs = {
+            "container_id": container_id,
+            "fingerprint": job_fingerprint,
+            "service_id": ("service_id=beep",),
+        }
+        job.next_run_time = datetime(year=1, month=2, day=3)
+        stored_jobs.append(job)
+    mocker.patch("deck_chores.jobs.scheduler").get_jobs.return_value = stored_jobs
+
+    assert restore_jobs(containers) == {"a"}
+
+    stored_jobs[0].remove.assert_not_called()
+    stored_jobs[0].pause.assert_called_once()
+    stored_jobs[1].remove.assert_called_once()
+    stored_jobs[2].remove.assert_called_once()
+    assert job_ids_by_container_id == {"a": {"a-beep"}}
+    assert service_locks_by_service_id == {("service_id=beep",): "a"}
+
+
+def test_restore_jobs_without_service_flag(cfg, mocker):
+    cfg.default_flags = "image"
+    labels = {"deck-chores.beep.command": "/beep.sh", "service_id": "beep"}
+    container = SimpleNamespace(
+        id="a", status="running", attrs={"Labels": labels, "ImageID": "sha256:b10a"}
+    )
+    job = mocker.MagicMock(spec_set=Job)
+    job.id = "a-beep"
+    job.kwargs = {
+        "container_id": "a",
+        "fingerprint": labels_fingerprint(labels, "sha256:b10a"),
+        "service_id": ("service_id=beep",),
+    }
+    mocker.patch("deck_chores.jobs.scheduler").get_jobs.return_value = [job]
+
+    assert restore_jobs([container]) == {"a"}
+    assert not service_locks_by_service_id
+
+
+def test_handle_reconcile(cfg, mocker):
+    cfg.reconciliation_interval = 60
+    handle_die = mocker.patch("deck_chores.main.handle_die")
+    handle_pause = mocker.patch("deck_chores.main.handle_pause")
+    handle_unpause = mocker.patch("deck_chores.main.handle_unpause")
+    process_started_container_labels = mocker.patch(
+        "deck_chores.main.process_started_container_labels"
+    )
+    for container_id, state in (
+        ("died", "running"),
+        ("paused", "running"),
+        ("unpaused", "paused"),
+        ("unchanged", "running"),
+        ("restarting", "running"),
+    ):
+        set_container_state(container_id, state)
+    containers = [
+        SimpleNamespace(id=container_id, status=status, attrs={})
+        for container_id, status in (
+            ("paused", "paused"),
+            ("unpaused", "running"),
+            ("unchanged", "running"),
+            ("restarting", "restarting"),
+            ("started", "paused"),
+        )
+    ]
+    started_at = 10 * RECONCILIATION_TIME_MARGIN
+    mocker.patch.dict("deck_chores.main._event_times")
+    # the listing doesn't reflect this yet
+    dispatch_event(
+        {
+            "Type": "container",
+            "Action": "start",
+            "Actor": {"ID": "recently-started"},
+            "timeNano": started_at - 1,
+        }
+    )
+
+    handle_reconcile(reconciliation_event(containers, started_at, 0.1))
+
+    handle_die.assert_called_once_with({"Actor": {"ID": "died"}})
+    handle_pause.assert_called_once_with({"Actor": {"ID": "paused"}})
+    handle_unpause.assert_called_once_with({"Actor": {"ID": "unpaused"}})
+    assert process_started_container_labels.mock_calls == [
+        mocker.call("recently-started", paused=False),
+        mocker.call("started", paused=True),
+    ]
+    assert container_states["started"] == "paused"
+    assert event_statistics["reconciled"] >= 4
+
+
+def test_reconciliation_is_limited(cfg, mocker):
+    handle_die = mocker.patch("deck_chores.main.handle_die")
+    for i in range(RECONCILIATION_LIMIT + 1):
+        set_container_state(f"{i:03}", "running")
+
+    handle_reconcile(reconciliation_event([], RECONCILIATION_TIME_MARGIN, 0.1))
+
+    assert handle_die.call_count == RECONCILIATION_LIMIT
+    assert (
+        handle_die.call_args.args[0]["Actor"]["ID"] == f"{RECONCILIATION_LIMIT - 1:03}"
+    )
+
+
+def test_periodic_reconciliation(cfg, mocker):
+    cfg.reconciliation_interval = 60
+    container = SimpleNamespace(id="a", status="running", attrs={})
+    cfg.client.containers.list.return_value = [container]
+    # the second interval ends the loop
+    sleep = mocker.patch("deck_chores.main.sleep", side_effect=[None, SystemExit])
+    events = Queue()
+
+    with raises(SystemExit):
+        reconcile_periodically(events)
+
+    sleep.assert_called_with(60)
+    event = events.get_nowait()
+    assert (event["Type"], event["Action"]) == ("deck-chores", "reconcile")
+    assert event["Containers"] == [container]
+    cfg.client.containers.list.assert_called_with(ignore_removed=True, sparse=True)
+
+
+def test_events_reconnection(cfg, mocker):
+    cfg.events_reconnect_attempts = 3
+    sleep = mocker.patch("deck_chores.main.sleep")
+    cfg.client.containers.list.return_value = []
+    first, second = (
+        {"Type": "container", "Action": "start", "Actor": {"ID": "a"}, "timeNano": t}
+        for t in (1_000_000_001, 1_000_000_002)
+    )
+
+    def interrupted_stream():
+        yield json.dumps(first)
+        raise ConnectionError("reset")
+
+    cfg.client.events.side_effect = [
+        ConnectionError("refused"),
+        (json.dumps(e) for e in (first, second)),
+    ] + [ConnectionError("refused")] * 3
+    events = Queue()
+
+    read_events(interrupted_stream(), events)
+
+    assert events.get_nowait() == first
+    # the daemon was unreachable and may have lost events
+    assert events.get_nowait()["Action"] == "reconcile"
+    assert events.get_nowait() == second
+    assert isinstance(events.get_nowait(), ConnectionError)
+    assert events.empty()
+    assert [c.kwargs["since"] for c in cfg.client.events.mock_calls] == [
+        "1.000000001",
+        "1.000000001",
+        "1.000000002",
+        "1.000000002",
+        "1.000000002",
+    ]
+    # the backoff is reset by a received event
+    assert [c.args[0] for c in sleep.mock_calls] == [0, 0.5, 0, 0.5, 1]
+
+
+def test_timings_dump(cfg, mocker, tmp_path):
+    cfg.timings_file = str(tmp_path / "timings.json")
+    mocker.patch("deck_chores.jobs.scheduler").get_jobs.return_value = []
+
+    report_state()
+
+    timings = json.loads((tmp_path / "timings.json").read_text())
+    assert set(timings) == {"start_delay", "run_time", "missed_by", "queue_wait"}
+
+
+def test_sigusr1_handler_doesnt_wait_for_locks(cfg, mocker):
+    cfg.timings_file = "timings.json"
+    mocker.patch("deck_chores.jobs.scheduler").get_jobs.return_value = []
+    reported = Event()
+    mocker.patch("deck_chores.main.dump_timings", side_effect=lambda _: reported.set())
+
+    # as if the signal interrupted the main thread while it records a timing
+    with metrics._lock:
+        sigusr1_handler(None, None)
+        assert not reported.is_set()
+
+    assert reported.wait(5)
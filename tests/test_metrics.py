@@ -0,0 +1,99 @@
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+import pytest
+
+from deck_chores import metrics
+from deck_chores.metrics import (
+    discard_job_timings,
+    increment,
+    observe,
+    record_timing,
+    register_collector,
+    render,
+    serve,
+    timings_report,
+)
+
+
+@pytest.fixture(autouse=True)
+def reset_metrics(monkeypatch):
+    for name in ("_values", "_histograms", "_collectors", "_job_timings"):
+        monkeypatch.setattr(metrics, name, {})
+    for timings in metrics._timings.values():
+        timings.clear()
+
+
+def test_render():
+    increment("deck_chores_events_received_total", action="start")
+    increment("deck_chores_events_received_total", 2, action="start")
+    increment("deck_chores_job_executions_total", exit_code='1')
+    observe("deck_chores_execution_seconds", 0.003)
+    observe("deck_chores_execution_seconds", 7200)
+    register_collector(
+        "deck_chores_cache_hits_total",
+        "counter",
+        "Cache hits.",
+        lambda: (({"cache": 'say "hi"'}, 5),),
+    )
+
+    lines = render().splitlines()
+
+    assert lines[:5] == [
+        "# HELP deck_chores_events_received_total "
+        "Events that were received from the Docker daemon.",
+        "# TYPE deck_chores_events_received_total counter",
+        'deck_chores_events_received_total{action="start"} 3',
+        "# HELP deck_chores_job_executions_total "
+        "Executions of jobs' commands that finished.",
+        "# TYPE deck_chores_job_executions_total counter",
+    ]
+    assert 'deck_chores_execution_seconds_bucket{le="0.001"} 0' in lines
+    assert 'deck_chores_execution_seconds_bucket{le="0.005"} 1' in lines
+    assert 'deck_chores_execution_seconds_bucket{le="3600"} 1' in lines
+    assert 'deck_chores_execution_seconds_bucket{le="+Inf"} 2' in lines
+    assert "deck_chores_execution_seconds_sum 7200" in lines
+    assert "deck_chores_execution_seconds_count 2" in lines
+    assert lines[-1] == 'deck_chores_cache_hits_total{cache="say \\"hi\\""} 5'
+
+
+def test_serve():
+    increment("deck_chores_job_runs_missed_total")
+    server = serve(0)
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    try:
+        with urlopen(f"{url}/metrics") as response:
+            assert response.headers["Content-Type"].startswith("text/plain")
+            assert b"\ndeck_chores_job_runs_missed_total 1\n" in response.read()
+        with pytest.raises(HTTPError, match="404"):
+            urlopen(f"{url}/")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_timings_report():
+    for i in range(1, 101):
+        record_timing("start_delay", "a" if i % 2 else "b", i / 100)
+    record_timing("run_time", "a", 3)
+
+    report = timings_report()
+
+    assert report["start_delay"]["all"] == {
+        "count": 100,
+        "p50": 0.5,
+        "p90": 0.9,
+        "p99": 0.99,
+        "max": 1.0,
+    }
+    assert report["start_delay"]["jobs"]["b"]["max"] == 1.0
+    assert report["run_time"]["jobs"] == {
+        "a": {"count": 1, "p50": 3, "p90": 3, "p99": 3, "max": 3}
+    }
+    assert report["missed_by"] == {"all": {"count": 0}, "jobs": {}}
+
+    discard_job_timings("a")
+    assert set(timings_report()["start_delay"]["jobs"]) == {"b"}
+    # the overall timings are kept
+    assert timings_report()["start_delay"]["all"]["count"] == 100
@@ -1,16 +1,26 @@
 from datetime import datetime
+from itertools import product
+from random import Random
 
+from dateutil.parser import isoparse as parse_iso_timestamp
 from docker.models.containers import Container
 from pytest import mark
 
-from deck_chores.main import parse_iso_timestamp
+from deck_chores.indexes import discard_prefetched_attributes, prefetch_attributes
 from deck_chores.parsers import (
+    image_definition_labels,
+    parse_concurrency,
     parse_flags,
     parse_labels,
     CronTrigger,
     DateTrigger,
     IntervalTrigger,
+    compiled_job_config_validator,
+    job_config_validator,
     JobConfigValidator,
+    labels_fingerprint,
+    parse_job_definitions,
+    validate_job_definition,
 )
 
 
@@ -47,8 +57,9 @@ def test_parse_labels(cfg, mocker):
     }
     container = mocker.MagicMock(Container)
     container.labels = labels
-    container.image.labels = {}
+    container.attrs = {'Image': 'sha256:b10a'}
     cfg.client.containers.get.return_value = container
+    cfg.client.api.inspect_image.return_value = {'Config': {'Labels': None}}
 
     expected_jobs = {
         'backup': {
@@ -82,6 +93,7 @@ def test_parse_labels(cfg, mocker):
     assert len(job_definitions) == len(expected_jobs)
     for name, job_config in job_definitions.items():
         job_config.pop('service_id')
+        job_config.pop('fingerprint')
         assert job_config.pop('timezone') == 'UTC'
         assert job_config == expected_jobs[name]
 
@@ -106,8 +118,9 @@ def test_parse_labels_with_time_units(cfg, mocker):
     }
     container = mocker.MagicMock(Container)
     container.labels = labels
-    container.image.labels = {}
+    container.attrs = {'Image': 'sha256:b10a'}
     cfg.client.containers.get.return_value = container
+    cfg.client.api.inspect_image.return_value = {'Config': {'Labels': None}}
 
     expected_jobs = {
         'backup': {
@@ -134,6 +147,7 @@ def test_parse_labels_with_time_units(cfg, mocker):
     assert len(job_definitions) == len(expected_jobs), job_definitions
     for name, job_config in job_definitions.items():
         job_config.pop('service_id')
+        job_config.pop('fingerprint')
         assert job_config.pop('timezone') == 'UTC'
         assert job_config == expected_jobs[name]
 
@@ -147,8 +161,9 @@ def test_parse_labels_with_user_option(cfg, mocker):
     image_labels = {'deck-chores.options.user': 'l_options_user'}
     container = mocker.MagicMock(Container)
     container.labels = labels
-    container.image.labels = image_labels
+    container.attrs = {'Image': 'sha256:b10a'}
     cfg.client.containers.get.return_value = container
+    cfg.client.api.inspect_image.return_value = {'Config': {'Labels': image_labels}}
 
     expected_jobs = {
         'job': {
@@ -159,6 +174,7 @@ def test_parse_labels_with_user_option(cfg, mocker):
             'max': 1,
             'timezone': 'UTC',
             'environment': {},
+            'fingerprint': labels_fingerprint(labels, 'sha256:b10a'),
         }
     }
 
@@ -174,8 +190,9 @@ def test_parse_labels_with_user_option_from_image(cfg, mocker):
     image_labels = {'deck-chores.options.user': 'l_options_user'}
     container = mocker.MagicMock(Container)
     container.labels = labels
-    container.image.labels = image_labels
+    container.attrs = {'Image': 'sha256:b10a'}
     cfg.client.containers.get.return_value = container
+    cfg.client.api.inspect_image.return_value = {'Config': {'Labels': image_labels}}
 
     expected_jobs = {
         'job': {
@@ -186,6 +203,7 @@ def test_parse_labels_with_user_option_from_image(cfg, mocker):
             'max': 1,
             'timezone': 'UTC',
             'environment': {},
+            'fingerprint': labels_fingerprint(labels, 'sha256:b10a'),
         }
     }
 
@@ -195,6 +213,169 @@ def test_parse_labels_with_user_option_from_image(cfg, mocker):
     assert job_definitions == expected_jobs, job_definitions
 
 
+def test_parse_labels_of_prefetched_container(cfg, mocker):
+    container = mocker.MagicMock(Container)
+    container.id = 'test_parse_labels_of_prefetched_container'
+    container.attrs = {
+        'Labels': {
+            'deck-chores.job.command': 'a_command',
+            'deck-chores.job.interval': 'hourly',
+        },
+        'ImageID': 'sha256:b10a',
+    }
+    cfg.client.api.inspect_image.return_value = {'Config': {'Labels': {}}}
+
+    prefetch_attributes([container])
+    try:
+        _, _, job_definitions = parse_labels(container.id)
+    finally:
+        discard_prefetched_attributes()
+
+    assert job_definitions['job']['command'] == 'a_command'
+    cfg.client.containers.get.assert_not_called()
+    cfg.client.api.inspect_image.assert_called_once_with('sha256:b10a')
+
+
+def test_image_labels_are_fetched_once_per_image(cfg, mocker):
+    container = mocker.MagicMock(Container)
+    container.labels = {'deck-chores.options.user': 'c_options_user'}
+    container.attrs = {'Image': 'sha256:b10a'}
+    cfg.client.containers.get.return_value = container
+    cfg.client.api.inspect_image.return_value = {
+        'Config': {
+            'Labels': {
+                'deck-chores.job.command': 'a_command',
+                'deck-chores.job.interval': 'hourly',
+                'deck-chores.options.user': 'l_options_user',
+                'org.opencontainers.image.title': 'an image',
+            }
+        }
+    }
+
+    for i in range(3):
+        _, _, job_definitions = parse_labels(f'test_image_labels_cache_{i}')
+        assert job_definitions['job']['user'] == 'c_options_user'
+
+    cfg.client.api.inspect_image.assert_called_once_with('sha256:b10a')
+    assert image_definition_labels('sha256:b10a') == {
+        'deck-chores.job.command': 'a_command',
+        'deck-chores.job.interval': 'hourly',
+        'deck-chores.options.user': 'l_options_user',
+    }
+
+
+def test_fingerprint_reflects_the_configuration(cfg):
+    labels = {'deck-chores.job.command': 'a_command'}
+    fingerprints = {labels_fingerprint(labels, 'sha256:b10a')}
+
+    cfg.schedule_spread = 60
+    fingerprints.add(labels_fingerprint(labels, 'sha256:b10a'))
+    # the stored jobs' functions depend on the runtime
+    cfg.runtime = 'asyncio'
+    fingerprints.add(labels_fingerprint(labels, 'sha256:b10a'))
+    assert len(fingerprints) == 3
+
+
+def test_validated_job_definitions_are_memoized(cfg):
+    labels = {
+        'deck-chores.job.command': 'a_command',
+        'deck-chores.job.interval': 'hourly',
+        'deck-chores.job.env.FOO': 'bar',
+    }
+
+    first = parse_job_definitions(labels, user='')
+    first['job'].update({'job_id': 'x', 'container_id': 'a'})
+    first['job']['environment']['FOO'] = 'baz'
+    second = parse_job_definitions(labels, user='')
+
+    assert second == {
+        'job': {
+            'trigger': (IntervalTrigger, (0, 0, 1, 0, 0)),
+            'name': 'job',
+            'command': 'a_command',
+            'user': '',
+            'max': 1,
+            'timezone': 'UTC',
+            'environment': {'FOO': 'bar'},
+        }
+    }
+    assert validate_job_definition.cache_info().hits == 1
+    assert validate_job_definition.cache_info().misses == 1
+
+    assert parse_job_definitions(labels, user='www-data')['job']['user'] == 'www-data'
+    assert validate_job_definition.cache_info().misses == 2
+
+
+VALIDATION_SAMPLES = {
+    'command': ('/backup.sh', '', 'sh -c "echo $FOO"'),
+    'cron': ('*/10 * * * *', '1-4 0 0', '  sun 1   0 0 ', '', '99 * *', 'a b c'),
+    'date': ('1945-05-08 00:01:00', '2030-01-01', 'tomorrow', ''),
+    'environment': ({}, {'FOO': 'bar'}, 'FOO=bar'),
+    'interval': ('daily', '15', '42:00:00', '2 weeks', '3 xongs', '', 'a:b', '1:x'),
+    'jitter': ('600', '0.5 day', '-5', '1.5', 'abc', '', '..5s'),
+    'max': ('3', '0', '-1', 'x', '2.0'),
+    'name': ('job', 'a-job', 'A.job', '', 'job\n'),
+    'output_limit': ('1024', '10M', '1.5k', '-1', 'x', ''),
+    'priority': ('high', 'normal', 'low', 'urgent', ''),
+    'timezone': ('UTC', 'Europe/Berlin', 'Mars/Olympus', ''),
+    'user': ('', 'www-data', '1000', '!root', '-x'),
+    'workdir': ('/srv', 'srv', '', '/'),
+    'unknown': ('value',),
+}
+
+
+def validation_samples():
+    yield from (
+        {'command': 'x', 'name': 'job', 'user': '', trigger: value}
+        for trigger in ('cron', 'date', 'interval')
+        for value in VALIDATION_SAMPLES[trigger]
+    )
+    yield from (
+        {'command': 'x', 'name': 'job', 'user': '', **dict(zip(fields, values))}
+        for fields in (('cron', 'date'), ('date', 'jitter'), ('cron', 'interval'))
+        for values in product(*(VALIDATION_SAMPLES[f] for f in fields))
+    )
+    random = Random(0)
+    fields = tuple(VALIDATION_SAMPLES)
+    for _ in range(500):
+        yield {
+            field: random.choice(VALIDATION_SAMPLES[field])
+            for field in random.sample(fields, random.randint(1, len(fields)))
+        }
+    optional_fields = (
+        'environment',
+        'jitter',
+        'max',
+        'output_limit',
+        'priority',
+        'timezone',
+        'workdir',
+    )
+    for _ in range(500):
+        document = {
+            'command': 'x',
+            'name': 'job',
+            'user': random.choice(VALIDATION_SAMPLES['user'][:3]),
+        }
+        trigger = random.choice(('cron', 'date', 'interval'))
+        document[trigger] = random.choice(VALIDATION_SAMPLES[trigger][:3])
+        for field in random.sample(optional_fields, random.randint(0, 7)):
+            document[field] = random.choice(VALIDATION_SAMPLES[field])
+        yield document
+
+
+@mark.parametrize('debug', (False, True))
+def test_compiled_validator_is_equivalent_to_cerberus(cfg, debug):
+    cfg.debug = debug
+    for document in validation_samples():
+        expected = job_config_validator.validated(document)
+        result = compiled_job_config_validator.validated(document)
+        assert result == expected, document
+        assert (
+            compiled_job_config_validator.errors == job_config_validator.errors
+        ), document
+
+
 def test_interval_trigger():
     validator = JobConfigValidator({'trigger': {'coerce': 'interval'}})
     result = validator.validated({'trigger': '15'})['trigger']
@@ -216,3 +397,10 @@ def test_flags(cfg, mocker, default, value, result):
     container.labels = {'deck-chores.options.flags': value}
     cfg.client.containers.get.return_value = container
     assert parse_flags(value) == result
+
+
+@mark.parametrize(
+    'value,result', (('', None), ('2', 2), ('0', None), ('-1', None), ('x', None))
+)
+def test_concurrency_option(value, result):
+    assert parse_concurrency(value) == result